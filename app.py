@@ -1,9 +1,8 @@
 import streamlit as st
 import pandas as pd
 import requests
-import base64
-import io
-from PIL import Image
+import json
+import time
 
 
 
@@ -37,6 +36,18 @@ def get_chat_history(user_id):
 
 
 
+def wait_until_ready(file_id, timeout=300):
+    """Poll the backend until the uploaded file has been parsed."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        response = requests.get(f"{BACKEND_URL}/upload/status/{file_id}", timeout=10)
+        data = response.json()
+        if data.get("status") != "processing":
+            return data.get("status"), data.get("error")
+        time.sleep(0.5)
+    return "processing", "Timed out waiting for the file to be parsed"
+
+
 # File Upload Function
 
 def file_upload_interface():
@@ -69,6 +80,10 @@ def file_upload_interface():
                     if response.status_code == 200:
                         data = response.json()
                         file_id = data["file_id"]
+                        status, error = wait_until_ready(file_id)
+                        if status != "ready":
+                            st.error(f"Upload failed: {error}")
+                            st.stop()
                         
                         st.session_state.uploaded_files[file_id] = {
                             "name": uploaded_file.name,
@@ -112,6 +127,10 @@ def file_upload_interface():
         col1, col2 = st.columns([3, 1])
         with col2:
             if st.button("🗑️ Remove Selected File"):
+                try:
+                    requests.delete(f"{BACKEND_URL}/upload/{st.session_state.selected_file_id}", timeout=10)
+                except requests.exceptions.RequestException:
+                    st.warning("Backend not reachable; the file was only removed locally.")
                 del st.session_state.uploaded_files[st.session_state.selected_file_id]
                 st.session_state.selected_file_id = (
                     list(st.session_state.uploaded_files.keys())[0] 
@@ -124,6 +143,19 @@ def file_upload_interface():
     return None
 
 
+def stream_chat(payload):
+    """Yield (event, data) pairs from the backend's Server-Sent Events chat endpoint."""
+    with requests.post(f"{BACKEND_URL}/chat/stream", json=payload, stream=True) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"Backend error: {response.text}")
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                yield event, json.loads(line[len("data: "):])
+
+
 #  Chat Interface
 def run_chat_interface(file_id, chat_name):
     """Display the chat interface for asking questions"""
@@ -146,24 +178,38 @@ def run_chat_interface(file_id, chat_name):
         if not query.strip():
             st.warning("Please enter a question first.")
         else:
-            with st.spinner("Analyzing data..."):
-                try:
-                    payload = {
-                        "query": query, 
-                        "file_id": file_id, 
-                        "user_id": st.session_state.user_id
-                    }
-                    response = requests.post(f"{BACKEND_URL}/chat/", json=payload)
-
-                    if response.status_code == 200:
-                        data = response.json()
-                        
-                        # Store result in session state so it persists
-                        st.session_state.last_result = data
-                    else:
-                        st.error(f"Backend error: {response.text}")
-                except Exception as e:
-                    st.error(f"⚠️ Something went wrong: {e}")
+            status_box = st.empty()
+            code_box = st.empty()
+            try:
+                payload = {
+                    "query": query, 
+                    "file_id": file_id, 
+                    "user_id": st.session_state.user_id
+                }
+                status_box.info("Generating code...")
+                data = {}
+                code_text = ""
+                # Render the code as it is generated, then the result once executed
+                for event, payload_data in stream_chat(payload):
+                    if event == "token":
+                        code_text += payload_data["text"]
+                        code_box.code(code_text, language="python")
+                    elif event == "code":
+                        data["generated_code"] = payload_data["generated_code"]
+                    elif event == "status":
+                        status_box.info("Running code...")
+                    elif event in ("result", "image"):
+                        data.update(payload_data)
+                    elif event == "error":
+                        data["error"] = payload_data["error"]
+
+                status_box.empty()
+                code_box.empty()
+                # Store result in session state so it persists
+                st.session_state.last_result = data
+            except Exception as e:
+                status_box.empty()
+                st.error(f"⚠️ Something went wrong: {e}")
     
     # Display results if they exist in session state
     if "last_result" in st.session_state:
@@ -175,18 +221,21 @@ def run_chat_interface(file_id, chat_name):
         st.write("### 📊 Result:")
 
         result = data.get("result")
-        image = data.get("image")
+        image_id = data.get("image_id")
         error = data.get("error")
         
         if result is not None:
             st.write(result)
-        if image is not None:
+        if data.get("result_id") is not None:
+            st.caption(f"Showing the first rows of {data['rows']:,}.")
+            st.link_button("Download full result (Arrow)", f"{BACKEND_URL}/chat/result/{data['result_id']}/arrow")
+        if image_id is not None:
             try:
-                img_data = base64.b64decode(image)
-                image = Image.open(io.BytesIO(img_data))
-                st.image(image, caption="Generated plot")
-            except Exception:
-                st.error("Could not decode backend image")
+                response = requests.get(f"{BACKEND_URL}/chat/image/{image_id}", timeout=30)
+                response.raise_for_status()
+                st.image(response.content, caption="Generated plot")
+            except requests.exceptions.RequestException:
+                st.error("Could not load the plot from the backend")
         if error is not None:
             st.error(error)
         
@@ -0,0 +1,77 @@
+"""
+Synthetic sales CSVs of a given size for benchmarks. The same size and seed
+always give the same bytes.
+
+    python -m bench.datagen bench/data/sales-100MB.csv --size 100MB
+"""
+import argparse
+import os
+import re
+import numpy as np
+import pandas as pd
+
+REGIONS = np.array(["north", "south", "east", "west", "central"])
+PRODUCTS = np.array([f"product-{i:03d}" for i in range(200)])
+BLOCK_ROWS = 200_000  # Rows generated and written per step, so memory stays flat for multi-GB files
+_UNITS = {"": 1, "B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3}
+
+
+def parse_size(text) -> int:
+    """'500KB', '100MB', '2GB' or a plain number of bytes."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*", text.upper())
+    if match is None:
+        raise ValueError(f"Invalid size {text!r}")
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def _block(rng, start, rows):
+    quantity = rng.integers(1, 100, rows)
+    price = np.round(rng.uniform(1, 1000, rows), 2)
+    return pd.DataFrame({
+        "id": np.arange(start, start + rows),
+        "date": pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 5 * 365, rows), unit="D"),
+        "region": REGIONS[rng.integers(0, len(REGIONS), rows)],
+        "product": PRODUCTS[rng.integers(0, len(PRODUCTS), rows)],
+        "quantity": quantity,
+        "price": price,
+        "revenue": np.round(quantity * price, 2),
+    })
+
+
+def generate(path, size_bytes, seed=0) -> int:
+    """Write a CSV of about size_bytes (whole rows, so slightly more) to path and return its row count."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    rows = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        while f.tell() < size_bytes:
+            block = _block(rng, rows, BLOCK_ROWS)
+            text = block.to_csv(index=False, header=rows == 0, date_format="%Y-%m-%d")
+            # Trim the last block to the requested size
+            remaining = size_bytes - f.tell()
+            if len(text) > remaining:
+                text = text[:text.index("\n", remaining) + 1]
+            f.write(text)
+            rows += text.count("\n") - (1 if rows == 0 else 0)
+    return rows
+
+
+def ensure(path, size_bytes, seed=0):
+    """Generate path unless it already exists with at least size_bytes."""
+    if not os.path.exists(path) or os.path.getsize(path) < size_bytes:
+        generate(path, size_bytes, seed)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic sales CSV")
+    parser.add_argument("path")
+    parser.add_argument("--size", default="1MB", help="Target size, e.g. 1MB, 500MB, 2GB")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rows = generate(args.path, parse_size(args.size), args.seed)
+    print(f"{args.path}: {rows} rows, {os.path.getsize(args.path)} bytes")
+
+
+if __name__ == "__main__":
+    main()
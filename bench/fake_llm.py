@@ -0,0 +1,104 @@
+"""
+Deterministic stand-in for the ChatOpenAI model in calls.py, for benchmarks.
+
+    from bench import fake_llm
+    fake_llm.install(latency=0.2)
+
+or serve the API with it (for loadtest.py --url):
+
+    python -m bench.fake_llm --latency 0.2 --port 8000
+"""
+import argparse
+import asyncio
+import re
+from langchain_core.messages.ai import AIMessage, AIMessageChunk
+from prompt import large_file_prompt
+
+# Canned answers for the columns written by bench/datagen.py, chosen by the
+# first keyword (in this order) found in the query: "plot" comes first since
+# plot queries also name a column
+PANDAS_CODE = {
+    "plot": "import matplotlib.pyplot as plt\ndf.groupby('region', observed=True)['quantity'].sum().plot.bar()\nresult = 1",
+    "region": "result = df.groupby('region', observed=True)['revenue'].sum()",
+    "average": "result = df['price'].mean()",
+    "filter": "result = len(df[df['quantity'] > 50])",
+    "rows": "result = df[df['price'] > 900]",
+}
+ARROW_CODE = {
+    "region": "result = aggregate(ds, {'revenue': ('revenue', 'sum')}, by=['region'])",
+    "average": "result = aggregate(ds, {'price': ('price', 'mean')})['price'][0]",
+    "filter": "result = aggregate(ds, {'n': ('quantity', 'count')}, filter=pc.field('quantity') > 50)['n'][0]",
+    "rows": "result = scan(ds, columns=['id', 'price'], filter=pc.field('price') > 900)",
+}
+DEFAULT_CODE = "result = len(df)"
+DEFAULT_ARROW_CODE = "result = ds.count_rows()"
+CHARS_PER_TOKEN = 4
+STREAM_CHUNK_CHARS = 16
+
+
+class FakeLLM:
+    """
+    Answers like the chat model after `latency` seconds (spread over the chunks
+    when streaming), with canned code for the last user query. The query is
+    kept as a comment so that distinct queries give distinct code and are not
+    served from the result memo.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def _answer(self, messages):
+        content = str(messages[-1].content)
+        if not content.startswith("User query:"):
+            return "Earlier questions were about the benchmark data."  # History summarization
+        query = content.split("\n", 1)[0][len("User query:"):].strip()
+        canned, default = (ARROW_CODE, DEFAULT_ARROW_CODE) if large_file_prompt in content else (PANDAS_CODE, DEFAULT_CODE)
+        code = next((code for word, code in canned.items() if word in query.lower()), default)
+        comment = re.sub(r"\s+", " ", query)
+        return f"```python\n# {comment}\n{code}\n```"
+
+    @staticmethod
+    def _usage(messages, text):
+        prompt_tokens = sum(len(str(m.content)) for m in messages) // CHARS_PER_TOKEN
+        completion_tokens = len(text) // CHARS_PER_TOKEN
+        return {"input_tokens": prompt_tokens, "output_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    async def ainvoke(self, messages, **kwargs):
+        self.calls += 1
+        text = self._answer(messages)
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=text, usage_metadata=self._usage(messages, text))
+
+    async def astream(self, messages, **kwargs):
+        self.calls += 1
+        text = self._answer(messages)
+        pieces = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+        for piece in pieces:
+            await asyncio.sleep(self.latency / len(pieces))
+            yield AIMessageChunk(content=piece)
+        yield AIMessageChunk(content="", usage_metadata=self._usage(messages, text))
+
+
+def install(latency=0.0) -> FakeLLM:
+    """Replace the module-level model in calls.py; code_gen instances created afterwards use the fake."""
+    import calls
+    calls.llm = FakeLLM(latency)
+    return calls.llm
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve main.app with the fake LLM")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per LLM call")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    import uvicorn
+    install(args.latency)
+    import main as server
+    uvicorn.run(server.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Load test for main.app with the fake LLM (bench/fake_llm.py), no OpenAI calls.
+
+In-process (the app runs on this event loop through httpx's ASGI transport):
+
+    python -m bench.loadtest --size 10MB --requests 200 --concurrency 16 --latency 0.2
+
+Against a running server (python -m bench.fake_llm --port 8000):
+
+    python -m bench.loadtest --url http://127.0.0.1:8000 --pid <server pid>
+
+Reports requests/s, latency percentiles, peak RSS (the process tree, sandbox
+workers included) and event-loop lag, and compares them with the baseline in
+bench/baselines/ (written with --save-baseline). Exits with status 1 when a
+figure regressed by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import time
+import numpy as np
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import datagen, fake_llm  # noqa: E402
+
+QUERIES = [
+    "Total revenue by region",
+    "What is the average price?",
+    "How many orders have a quantity above 50? filter",
+    "Plot quantity by region",
+    "Show the rows with a price above 900",
+]
+BASELINE_DIR = os.path.join(ROOT, "bench", "baselines")
+LAG_INTERVAL = 0.01  # Seconds between event-loop lag probes
+RSS_INTERVAL = 0.1
+
+
+class Monitor:
+    """Samples event-loop lag and the RSS of a process tree in the background."""
+
+    def __init__(self, pid=None):
+        self.process = psutil.Process(pid)
+        self.lags = []
+        self.peak_rss = 0
+        self._task = None
+
+    def _rss(self):
+        total = 0
+        for p in [self.process] + self.process.children(recursive=True):
+            try:
+                total += p.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_rss = 0.0
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(max(0.0, loop.time() - start - LAG_INTERVAL))
+            if start >= next_rss:
+                self.peak_rss = max(self.peak_rss, self._rss())
+                next_rss = start + RSS_INTERVAL
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self.peak_rss = max(self.peak_rss, self._rss())
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    ms = np.array(values) * 1000
+    return {
+        "p50": round(float(np.percentile(ms, 50)), 1),
+        "p90": round(float(np.percentile(ms, 90)), 1),
+        "p99": round(float(np.percentile(ms, 99)), 1),
+        "max": round(float(ms.max()), 1),
+    }
+
+
+async def _upload(client, path):
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        response = await client.post("/upload/", files={"file": (os.path.basename(path), f, "text/csv")})
+    response.raise_for_status()
+    file_id = response.json()["file_id"]
+    while True:
+        status = (await client.get(f"/upload/status/{file_id}")).json()
+        if status["status"] != "processing":
+            break
+        await asyncio.sleep(0.05)
+    if status["status"] != "ready":
+        raise RuntimeError(f"Upload of {path} failed: {status['error']}")
+    return file_id, time.perf_counter() - start
+
+
+async def _chat_load(client, file_ids, requests, concurrency, unique, offset=0):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        i += offset
+        query = QUERIES[i % len(QUERIES)] + (f" #{i}" if unique else "")
+        body = {"user_id": "new", "file_id": file_ids[i % len(file_ids)], "query": query}
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post("/chat/", json=body)
+                failed = response.status_code != 200 or response.json().get("error") is not None
+            except Exception:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+        errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def run(args):
+    import httpx
+
+    size = datagen.parse_size(args.size)
+    data_dir = os.path.join(ROOT, "bench", "data")
+    paths = [datagen.ensure(os.path.join(data_dir, f"sales-{args.size}-{seed}.csv"), size, seed) for seed in range(args.uploads)]
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=None)
+        monitor = Monitor(args.pid)
+        app_context = None
+    else:
+        # The app writes its storage/ under the working directory. It starts
+        # empty, so the code cache and upload dedup of a previous run don't
+        # make this one faster
+        shutil.rmtree(os.path.join(args.workdir, "storage"), ignore_errors=True)
+        os.makedirs(args.workdir, exist_ok=True)
+        os.chdir(args.workdir)
+        os.environ.setdefault("OPENAI_API_KEY", "bench")
+        fake_llm.install(args.latency)
+        import main
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=None)
+        monitor = Monitor()
+        app_context = main.lifespan(main.app)
+        await app_context.__aenter__()
+
+    monitor.start()
+    try:
+        async with client:
+            uploads = await asyncio.gather(*(_upload(client, path) for path in paths))
+            file_ids = [file_id for file_id, _ in uploads]
+            # Warm-up: sandbox workers load their frames, measured requests start from a steady state
+            await _chat_load(client, file_ids, args.warmup, args.concurrency, args.unique, offset=args.requests)
+            monitor.lags.clear()
+            latencies, errors, elapsed = await _chat_load(client, file_ids, args.requests, args.concurrency, args.unique)
+    finally:
+        await monitor.stop()
+        if app_context is not None:
+            await app_context.__aexit__(None, None, None)
+
+    return {
+        "scenario": {
+            "size": args.size, "uploads": args.uploads, "requests": args.requests, "warmup": args.warmup,
+            "concurrency": args.concurrency, "latency": args.latency, "unique": args.unique,
+            "mode": "url" if args.url else "asgi",
+        },
+        "upload_seconds": round(max(seconds for _, seconds in uploads), 3),
+        "chat": {
+            "requests": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / elapsed, 2),
+            "latency_ms": _percentiles(latencies),
+        },
+        "peak_rss_mb": round(monitor.peak_rss / 1024**2, 1),
+        "loop_lag_ms": {key: _percentiles(monitor.lags)[key] for key in ("p99", "max")},
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Regression messages: throughput down, or p99 latency, RSS or loop lag up, by more than tolerance."""
+    checks = [
+        ("requests/s", report["chat"]["rps"], baseline["chat"]["rps"], -1),
+        ("p99 latency ms", report["chat"]["latency_ms"]["p99"], baseline["chat"]["latency_ms"]["p99"], 1),
+        ("peak RSS MB", report["peak_rss_mb"], baseline["peak_rss_mb"], 1),
+        ("p99 loop lag ms", report["loop_lag_ms"]["p99"], baseline["loop_lag_ms"]["p99"], 1),
+    ]
+    regressions = []
+    for name, value, before, worse in checks:
+        if value is None or not before:
+            continue
+        change = (value - before) / before
+        if change * worse > tolerance:
+            regressions.append(f"{name}: {before} -> {value} ({change:+.0%})")
+    if report["chat"]["errors"] > baseline["chat"]["errors"]:
+        regressions.append(f"errors: {baseline['chat']['errors']} -> {report['chat']['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /upload and /chat with a fake LLM")
+    parser.add_argument("--size", default="10MB", help="Size of each generated CSV, e.g. 1MB, 500MB, 2GB")
+    parser.add_argument("--uploads", type=int, default=1, help="Distinct files uploaded concurrently")
+    parser.add_argument("--requests", type=int, default=200, help="Total /chat requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent /chat requests")
+    parser.add_argument("--latency", type=float, default=0.2, help="Fake LLM seconds per call (in-process mode)")
+    parser.add_argument("--warmup", type=int, default=len(QUERIES), help="Unmeasured /chat requests sent first")
+    parser.add_argument("--cached", dest="unique", action="store_false",
+                        help="Repeat the same few queries, so most requests hit the code cache and result memo "
+                             "(by default every query is distinct and goes through the LLM and the sandbox)")
+    parser.add_argument("--url", help="Benchmark a running server instead of an in-process app")
+    parser.add_argument("--pid", type=int, help="With --url: server process whose RSS is sampled (default: this process)")
+    parser.add_argument("--workdir", default=os.path.join(ROOT, "bench", ".work"), help="Storage directory of the in-process app (its storage/ is emptied at start)")
+    parser.add_argument("--baseline", help="Baseline JSON (default: bench/baselines/<scenario>.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Write this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Allowed relative change before a regression is reported")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+
+    name = f"{args.size}-u{args.uploads}-c{args.concurrency}-l{args.latency}{'' if args.unique else '-cached'}"
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, f"{name}.json")
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"[REGRESSION] {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {baseline_path}")
+
+
+if __name__ == "__main__":
+    main()
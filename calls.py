@@ -1,32 +1,111 @@
 from langchain_core.messages.human import HumanMessage
 from langchain_core.messages.ai import AIMessage
 from langchain_core.messages.system import SystemMessage
-from langchain_community.chat_message_histories import ChatMessageHistory  # Correct import here
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import messages_from_dict, messages_to_dict
 from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 import os
-from prompt import prompt
+from prompt import prompt, summary_prompt, large_file_prompt
+from utils.code_cache import CodeCache
+from utils.tokens import count_tokens
+from utils import metrics
+from utils.scheduler import LLMScheduler, INTERACTIVE, BATCH, BACKGROUND
+from utils.state import STATE
+import asyncio
+import contextlib
+import time
 import uuid
 
 
 load_dotenv()
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=os.getenv("OPENAI_API_KEY"))
-SESSION_STORE = {}
-FEEDBACK_STORE = {}  # Store feedback per user_id: {user_id: [feedback1, feedback2, ...]}
+# stream_usage: streamed responses also report token usage (in their last chunk)
+# max_retries=0: retries are done by the scheduler, with backoff shared across requests
+llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=os.getenv("OPENAI_API_KEY"), stream_usage=True, max_retries=0)
+SESSION_TTL = float(os.getenv("SESSION_TTL_SECONDS", 3600))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 4000))  # Max prompt tokens sent per turn
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", 4))  # Recent question/answer pairs kept verbatim
+LLM_BATCH_CONCURRENCY = int(os.getenv("LLM_BATCH_CONCURRENCY", 8))  # Max concurrent LLM calls per batch
+CODE_CACHE = CodeCache()  # Generated code per (normalised query, schema fingerprint)
+SCHEDULER = LLMScheduler()  # Every LLM call goes through its queue and budgets
 
-def get_user_history(user_id: str) -> ChatMessageHistory:
-    if user_id not in SESSION_STORE:
-        user_id = str(uuid.uuid4())
-        SESSION_STORE[user_id] = ChatMessageHistory()
-    return SESSION_STORE[user_id], user_id
+class StateChatHistory(BaseChatMessageHistory):
+    """
+    Chat history of one session in the shared state (utils/state.py), so any
+    API worker can serve the next turn. Messages are a list appended to
+    atomically, so concurrent turns of a session don't overwrite each other.
+    Each write renews the SESSION_TTL expiry. Blocking; async code uses the
+    a* methods, which run these in a thread.
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+
+    @property
+    def messages(self):
+        return messages_from_dict(STATE.items("session", self.user_id))
+
+    def add_messages(self, messages):
+        STATE.push("session", self.user_id, messages_to_dict(messages), ttl=SESSION_TTL)
+
+    def replace_head(self, count, messages):
+        """Replace the first count messages, e.g. with a summary of them, keeping any added since they were read."""
+        STATE.replace_head("session", self.user_id, count, messages_to_dict(messages), ttl=SESSION_TTL)
+
+    def clear(self):
+        STATE.delete("session", self.user_id)
+
+def expire_sessions():
+    """Drop sessions that have been idle for longer than SESSION_TTL."""
+    STATE.purge_expired()
+
+def get_user_history(user_id: str) -> StateChatHistory:
+    # Renew the expiry on every access
+    if STATE.expire("session", user_id, SESSION_TTL):
+        return StateChatHistory(user_id), user_id
+    expire_sessions()  # Expired entries are skipped by reads; reclaim their space now and then
+    history = StateChatHistory(str(uuid.uuid4()))
+    history.add_message(SystemMessage(content=prompt))
+    return history, history.user_id
 
 def add_feedback(query: str, code, feedback):
     """Store feedback (thumbs_up, thumbs_down, or None) for the last query/result pair."""
-    if query not in FEEDBACK_STORE:
-        FEEDBACK_STORE[query] = []
-    
-    FEEDBACK_STORE[query]= [code, feedback]
-    print("Storing feedback:", FEEDBACK_STORE)
+    STATE.set("feedback", query, [code, feedback])
+    CODE_CACHE.feedback(query, code, feedback)
+    print("Storing feedback:", {query: [code, feedback]})
+
+def clean_code(text: str) -> str:
+    """Strip markdown code fences from a model response."""
+    generated_code = text.strip()
+    if "```python" in generated_code:
+        generated_code = generated_code.split("```python")[1].split("```")[0].strip()
+    elif "```" in generated_code:
+        generated_code = generated_code.split("```")[1].split("```")[0].strip()
+    return generated_code
+
+def _count_usage(message):
+    """Add the prompt/completion token counts reported with an LLM response to the metrics."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    for kind, key in (("prompt", "input_tokens"), ("completion", "output_tokens")):
+        if usage.get(key):
+            metrics.inc("llm_tokens_total", usage[key], help="Tokens used by LLM calls", kind=kind)
+
+async def _invoke(llm, messages, stage="llm", priority=INTERACTIVE):
+    """llm.ainvoke through SCHEDULER, timed as `stage` and with its token usage counted."""
+    with metrics.span(stage):
+        response = await SCHEDULER.invoke(llm, messages, priority)
+    _count_usage(response)
+    return response
+
+def _history_content(query):
+    return f"User query: {query}"
+
+def _user_content(query, profile):
+    """The current question with the profile. History keeps only _history_content, so the profile is sent once per prompt."""
+    content = f"{_history_content(query)}\nDataFrame profile:\n{profile['summary']}"
+    if profile.get("engine") == "arrow":
+        content += f"\n{large_file_prompt}"
+    return content
 
 class code_gen:
     def __init__(self, user_id: str):
@@ -34,31 +113,148 @@ class code_gen:
         self.llm = llm
         self.history, self.user_id = get_user_history(user_id)
 
-        if not any(isinstance(m, SystemMessage) for m in self.history.messages):
-            system_prompt = prompt
-            self.history.add_message(SystemMessage(content=system_prompt))
-
-    async def generate_code(self, query, df):
-        info = {
-            "shape": df.shape,  
-            "columns": list(df.columns),
-            "dtypes": df.dtypes.astype(str).to_dict(),
-        }
-        user_content = f"User query: {query} DataFrame info: {info}"
-        
-        self.history.add_user_message(user_content)
-        
-        # Get full messages from history and invoke
-        messages = self.history.messages
-        response = await self.llm.ainvoke(messages)
-        generated_code = response.content.strip()
-
-        # Clean code (remove markdown formatting)
-        if "```python" in generated_code:
-            generated_code = generated_code.split("```python")[1].split("```")[0].strip()
-        elif "```" in generated_code:
-            generated_code = generated_code.split("```")[1].split("```")[0].strip()
-
-        self.history.add_ai_message(generated_code)
-
-        return generated_code, self.user_id
\ No newline at end of file
+    @classmethod
+    async def open(cls, user_id: str):
+        """code_gen for user_id, with the session looked up in a thread (the state may be remote)."""
+        return await asyncio.to_thread(cls, user_id)
+
+    async def generate_code(self, query, profile):
+        """profile is the per-file data profile from data.get_profile."""
+        current = HumanMessage(content=_user_content(query, profile))
+
+        # Same question about the same schema: reuse the code without an LLM round-trip
+        generated_code = CODE_CACHE.get(query, profile["columns"], profile["dtypes"], profile.get("engine"))
+        if generated_code is None:
+            # Keep the prompt under the token budget, then invoke with the history
+            messages = await self._compact_history(current)
+            response = await _invoke(self.llm, messages + [current])
+            generated_code = clean_code(response.content)
+            CODE_CACHE.put(query, profile["columns"], profile["dtypes"], generated_code, profile.get("engine"))
+
+        await self.history.aadd_messages([HumanMessage(content=_history_content(query)), AIMessage(content=generated_code)])
+
+        return generated_code, self.user_id
+
+    async def stream_code(self, query, profile):
+        """
+        Like generate_code, but yields ("token", text) as the model streams and
+        finally ("code", cleaned_code).
+        """
+        current = HumanMessage(content=_user_content(query, profile))
+
+        generated_code = CODE_CACHE.get(query, profile["columns"], profile["dtypes"], profile.get("engine"))
+        if generated_code is None:
+            messages = await self._compact_history(current)
+            chunks = []
+            start = time.perf_counter()
+            async for chunk in SCHEDULER.stream(self.llm, messages + [current]):
+                _count_usage(chunk)
+                if chunk.content:
+                    chunks.append(chunk.content)
+                    yield "token", chunk.content
+            metrics.record("llm", time.perf_counter() - start)
+            generated_code = clean_code("".join(chunks))
+            CODE_CACHE.put(query, profile["columns"], profile["dtypes"], generated_code, profile.get("engine"))
+        else:
+            yield "token", generated_code
+
+        await self.history.aadd_messages([HumanMessage(content=_history_content(query)), AIMessage(content=generated_code)])
+        yield "code", generated_code
+
+    async def regenerate(self, query, profile, code, hint, priority=INTERACTIVE, semaphore=None):
+        """
+        Ask again for a query whose code the pre-flight analysis (utils/analyze.py)
+        found too slow, with its hint. When `code` is the latest answer in the
+        history, the hint and the new answer are added to it. A batch passes
+        its semaphore so the call counts against its concurrency.
+        """
+        messages = await self.history.aget_messages()
+        latest = bool(messages) and isinstance(messages[-1], AIMessage) and messages[-1].content == code
+        if latest:
+            messages = messages[:-2]  # Asked again below, with the profile
+        messages = messages + [HumanMessage(content=_user_content(query, profile)), AIMessage(content=code), HumanMessage(content=hint)]
+        async with semaphore or contextlib.nullcontext():
+            response = await _invoke(self.llm, messages, priority=priority)
+        generated_code = clean_code(response.content)
+        if latest:
+            await self.history.aadd_messages([HumanMessage(content=hint), AIMessage(content=generated_code)])
+        return generated_code
+
+    async def generate_batch(self, queries, profile, concurrency=LLM_BATCH_CONCURRENCY, semaphore=None):
+        """
+        Generate code for several independent queries about the same frame.
+        The profile is shared by all queries and at most `concurrency` LLM calls run
+        at a time; pass `semaphore` instead to share the limit with other calls of
+        the batch (see regenerate). Yields (index, code) as each query finishes, or
+        (index, exception) when its generation failed. Every query sees the
+        history as it was before the batch; the successful turns are appended
+        in query order at the end.
+        """
+        base = await self._compact_history(HumanMessage(content=_user_content(queries[0], profile)) if queries else None)
+        semaphore = semaphore or asyncio.Semaphore(concurrency)
+
+        async def generate(index, query):
+            try:
+                generated_code = CODE_CACHE.get(query, profile["columns"], profile["dtypes"], profile.get("engine"))
+                if generated_code is None:
+                    async with semaphore:
+                        response = await _invoke(self.llm, base + [HumanMessage(content=_user_content(query, profile))], priority=BATCH)
+                    generated_code = clean_code(response.content)
+                    CODE_CACHE.put(query, profile["columns"], profile["dtypes"], generated_code, profile.get("engine"))
+                return index, generated_code
+            except Exception as e:
+                return index, e
+
+        codes = [None] * len(queries)
+        for next_done in asyncio.as_completed([generate(i, q) for i, q in enumerate(queries)]):
+            index, generated_code = await next_done
+            codes[index] = generated_code
+            yield index, generated_code
+
+        turns = []
+        for query, generated_code in zip(queries, codes):
+            if isinstance(generated_code, str):
+                turns += [HumanMessage(content=_history_content(query)), AIMessage(content=generated_code)]
+        await self.history.aadd_messages(turns)
+
+    async def _compact_history(self, current=None):
+        """
+        Fold older turns into a single summary message once the history and
+        the current question (with its profile) exceed HISTORY_TOKEN_BUDGET.
+        The system prompt and the last HISTORY_KEEP_TURNS question/answer pairs
+        are kept verbatim. Returns the history to send before the current question.
+        """
+        messages = await self.history.aget_messages()
+        current = [current] if current is not None else []
+        with metrics.span("history"):
+            tokens = count_tokens(messages + current)
+        if tokens <= HISTORY_TOKEN_BUDGET:
+            return messages
+
+        system = [m for m in messages if isinstance(m, SystemMessage) and m.name != "summary"]
+        summary = [m for m in messages if isinstance(m, SystemMessage) and m.name == "summary"]
+        turns = [m for m in messages if not isinstance(m, SystemMessage)]
+
+        # Messages alternate question/answer
+        keep = len(turns) - min(len(turns), 2 * HISTORY_KEEP_TURNS)
+        while keep < len(turns) and not isinstance(turns[keep], HumanMessage):
+            keep += 1
+        while keep < len(turns) and count_tokens(system + summary + turns[keep:] + current) > HISTORY_TOKEN_BUDGET:
+            keep += 2
+        old, recent = turns[:keep], turns[keep:]
+        if not old:
+            return messages
+
+        transcript = "\n".join(f"{m.type}: {m.content}" for m in summary + old)
+        try:
+            response = await _invoke(self.llm, [SystemMessage(content=summary_prompt), HumanMessage(content=transcript)], stage="summarize", priority=BACKGROUND)
+            text = response.content.strip()
+        except Exception as e:
+            # Without a summary, at least remember which questions were asked
+            print(f"[HISTORY] Summarization failed: {e}")
+            text = "Earlier questions: " + "; ".join(str(m.content) for m in old if isinstance(m, HumanMessage))
+
+        # Only the messages read above are replaced; turns added meanwhile by other requests stay after them
+        summarized = system + [SystemMessage(content=f"Summary of the earlier conversation: {text}", name="summary")] + recent
+        await asyncio.to_thread(self.history.replace_head, len(messages), summarized)
+        return summarized
@@ -1,19 +1,589 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import asyncio
+import hashlib
+import json
+import re
+import shutil
 import uuid
 import os
+from utils.cache import LRUCache
+from utils.profile import build_profile, build_dataset_profile, PROFILE_SAMPLE_ROWS
+from utils.dtypes import optimize_dtypes, fits
+from utils import outofcore, metrics
+from utils.state import STATE, lease
 
 UPLOAD_DIR = "storage/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-_cache = {}
+CHUNK_SIZE = 1024 * 1024  # Bytes read from the upload stream per iteration
+LARGE_FILE_BYTES = int(os.getenv("LARGE_FILE_BYTES", 1024**3))  # Bigger uploads are queried out-of-core
+CACHE_MAX_BYTES = int(os.getenv("CSV_CACHE_MAX_BYTES", 2 * 1024**3))  # In-memory budget for parsed frames
+_cache = LRUCache(CACHE_MAX_BYTES, sizeof=lambda df: int(df.memory_usage(deep=True).sum()))
+_loaded = {}  # {file_id: content hash of the cached frame}
+_tasks = set()  # Keep references to background parse tasks
+# File metadata lives in the shared state (utils/state.py) so that every API
+# worker sees it; the data itself is on disk under UPLOAD_DIR. Every upload has
+# its own file_id, pointing to a stored copy ("store") that uploads of the same
+# content share. Namespaces:
+#   upload   file_id -> store id (uploads from before per-upload ids are their own store)
+#   released file_id -> True for an hour after the upload was deleted
+#   status   store -> {"status": "processing" | "ready" | "failed", "error"}
+#   hash     store -> sha256 of the stored CSV
+#   by_hash  sha256 -> store, for deduplication
+#   refs     store -> number of uploads sharing it
+#   profile  store -> data profile, see utils/profile.py
+# The public functions below take a file_id (or a store id, which maps to itself).
+INDEX_PATH = os.path.join(UPLOAD_DIR, "index.json")  # Dedup index of older versions, migrated once
+
+
+def _migrate_index():
+    if not os.path.exists(INDEX_PATH):
+        return
+    with open(INDEX_PATH, encoding="utf-8") as f:
+        index = json.load(f)
+    for sha, file_id in index["by_hash"].items():
+        STATE.add("by_hash", sha, file_id)
+        STATE.add("hash", file_id, sha)
+    for file_id, refs in index["refs"].items():
+        STATE.add("refs", file_id, refs)
+    try:
+        os.replace(INDEX_PATH, INDEX_PATH + ".migrated")
+    except FileNotFoundError:
+        pass  # Another worker migrated it
+
+
+_migrate_index()
+
+
+def _store(file_id):
+    """Id of the stored copy an upload refers to."""
+    return STATE.get("upload", file_id) or file_id
+
+
+def _set_status(file_id, status, error=None):
+    STATE.set("status", file_id, {"status": status, "error": error})
+
+
+async def _stream_to_disk(file, path):
+    """Write an upload to path chunk by chunk and return the sha256 of its bytes."""
+    digest = hashlib.sha256()
+    f = await asyncio.to_thread(open, path, "wb")
+    try:
+        while chunk := await file.read(CHUNK_SIZE):
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+    finally:
+        await asyncio.to_thread(f.close)
+    return digest.hexdigest()
+
 
 async def save_csv(file):
+    """
+    Stream the upload to disk chunk by chunk, hashing it on the way, and parse
+    it in a worker thread. Content that is already stored is not kept or parsed
+    again: the new file_id refers to the existing copy, whose reference count
+    goes up. Returns the file_id immediately; poll get_status() until it is "ready".
+    """
     file_id = str(uuid.uuid4())
-    filepath = os.path.join(UPLOAD_DIR, f"{file_id}.csv")
-    with open(filepath, "wb") as f:
-        f.write(await file.read())
-    df = pd.read_csv(filepath)
-    _cache[file_id] = df
+    partpath = os.path.join(UPLOAD_DIR, f"{file_id}.part")
+    try:
+        with metrics.span("upload"):
+            sha = await _stream_to_disk(file, partpath)
+    except BaseException:
+        # The client went away or the read failed; don't leave the partial file behind
+        if os.path.exists(partpath):
+            os.remove(partpath)
+        raise
+
+    store = await asyncio.to_thread(_claim, file_id, sha, partpath)
+    if store is not None:
+        task = asyncio.create_task(asyncio.to_thread(_parse_csv, store, _csv_path(store)))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
     return file_id
 
-def get_csv(file_id):
-    return _cache.get(file_id)
+
+def _claim(file_id, sha, partpath):
+    """
+    Point file_id to the stored copy of its content: the one another upload (in
+    any worker) already made, or a new one from partpath, whose id is returned
+    so it can be parsed. Blocking (state round trips); call from a thread.
+    """
+    store = str(uuid.uuid4())
+    if not STATE.add("by_hash", sha, store):
+        existing = STATE.get("by_hash", sha)
+        if existing is not None and os.path.exists(_csv_path(existing)):
+            os.remove(partpath)
+            STATE.add("refs", existing, 1)  # Uploads from before reference counting
+            STATE.incr("refs", existing)
+            STATE.set("upload", file_id, existing)
+            return None
+        STATE.set("by_hash", sha, store)
+
+    os.replace(partpath, _csv_path(store))
+    STATE.set("hash", store, sha)
+    STATE.set("refs", store, 1)
+    _set_status(store, "processing")
+    STATE.set("upload", file_id, store)
+    return store
+
+
+async def append_csv(file_id, file):
+    """
+    Append the rows of an uploaded CSV (with the same header) to file_id. Only
+    the new rows are parsed; they are checked against the existing columns and
+    dtypes, then the cached frame, Feather copy (or Parquet dataset), profile
+    and content hash are updated. When other uploads share the stored copy,
+    file_id first gets a copy of its own, so they don't see the new rows.
+    Raises ValueError when the rows don't fit the schema.
+    Returns (rows appended, total rows).
+    """
+    # One append at a time per file, across all workers
+    async with lease(STATE, f"append:{file_id}"):
+        partpath = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}.part")
+        try:
+            await _stream_to_disk(file, partpath)
+            store = await asyncio.to_thread(_own_store, file_id)
+            if is_large(store):
+                appended = await asyncio.to_thread(_append_large, store, partpath)
+            else:
+                appended = await asyncio.to_thread(_append_frame, store, partpath)
+        finally:
+            # Also when the client went away mid-stream (a cancellation, so no awaiting here)
+            if os.path.exists(partpath):
+                os.remove(partpath)
+        return appended, await asyncio.to_thread(_rehash, store)
+
+
+def _own_store(file_id):
+    """
+    The stored copy of file_id, copied first when other uploads refer to it.
+    Uploads from before per-upload ids share their id, so they keep appending
+    in place.
+    """
+    store = _store(file_id)
+    sha = STATE.get("hash", store)
+    if store == file_id or STATE.get("refs", store, 1) <= 1:
+        # No new upload may join content that is about to change
+        if STATE.get("by_hash", sha) == store:
+            STATE.delete("by_hash", sha)
+        if store == file_id or STATE.get("refs", store, 1) <= 1:
+            return store
+        STATE.add("by_hash", sha, store)  # Another upload joined meanwhile; it keeps the original
+
+    copy = str(uuid.uuid4())
+    for path in (_csv_path, _feather_path):
+        if os.path.exists(path(store)):
+            shutil.copyfile(path(store), path(copy))
+    if is_large(store):
+        shutil.copytree(_dataset_path(store), _dataset_path(copy))
+    for ns in ("hash", "profile", "status"):
+        value = STATE.get(ns, store)
+        if value is not None:
+            STATE.set(ns, copy, value)
+    STATE.set("refs", copy, 1)
+    STATE.set("upload", file_id, copy)
+    _release(store)
+    print(f"[INGEST] {file_id}: copied shared file {store} to {copy} before appending")
+    return copy
+
+
+def _rehash(store):
+    """Record the new content hash of store after an append; returns its row count."""
+    old_sha = STATE.get("hash", store)
+    new_sha = _hash_file(_csv_path(store))
+    STATE.set("hash", store, new_sha)
+    if store in _cache:
+        _loaded[store] = new_sha
+    if STATE.get("by_hash", old_sha) == store:
+        STATE.delete("by_hash", old_sha)
+    STATE.add("by_hash", new_sha, store)
+    return get_profile(store)["rows"]
+
+
+def _check_header(file_id, partpath):
+    with open(_csv_path(file_id), "rb") as f:
+        header = f.readline().rstrip(b"\r\n")
+    with open(partpath, "rb") as f:
+        new_header = f.readline().rstrip(b"\r\n")
+    if new_header != header:
+        raise ValueError(f"Header {new_header.decode(errors='replace')!r} does not match {header.decode(errors='replace')!r}")
+
+
+def _append_csv_rows(file_id, partpath):
+    """Append the rows of partpath (without its header) to the stored CSV."""
+    with open(_csv_path(file_id), "rb+") as out, open(partpath, "rb") as f:
+        out.seek(0, os.SEEK_END)
+        if out.tell() > 0:
+            out.seek(-1, os.SEEK_END)
+            if out.read(1) != b"\n":
+                out.write(b"\n")
+        f.readline()
+        while chunk := f.read(CHUNK_SIZE):
+            out.write(chunk)
+
+
+def _coerce_like(old: pd.Series, new: pd.Series):
+    """Return (old, new) with new converted to old's dtype, widening old when a number needs more room."""
+    if isinstance(old.dtype, pd.CategoricalDtype):
+        missing = pd.Index(new.dropna().unique()).difference(old.cat.categories)
+        old = old.cat.add_categories(missing)
+        return old, new.astype(old.dtype)
+    if pd.api.types.is_datetime64_any_dtype(old.dtype):
+        parsed = pd.to_datetime(new, errors="coerce")
+        if parsed.isna().sum() != new.isna().sum():
+            raise ValueError(f"Column {old.name!r} expects dates")
+        return old, parsed.astype(old.dtype)
+    if pd.api.types.is_bool_dtype(old.dtype):
+        if not pd.api.types.is_bool_dtype(new.dtype):
+            raise ValueError(f"Column {old.name!r} expects True/False values")
+        return old, new
+    if pd.api.types.is_numeric_dtype(old.dtype):
+        if not pd.api.types.is_numeric_dtype(new.dtype):
+            raise ValueError(f"Column {old.name!r} expects numbers, got {new.dtype}")
+        # Keep the compacted dtype (utils/dtypes.py) when the new values fit it
+        if fits(new, old.dtype):
+            return old, new.astype(old.dtype)
+        common = np.promote_types(old.dtype, new.dtype)
+        if new.isna().any() and common.kind in "iu":
+            common = np.dtype(np.float64)
+        # Widened as far as ingest would have: int64 or float64
+        common = np.promote_types(common, np.int64 if common.kind in "iu" else np.float64)
+        return old.astype(common, copy=False), new.astype(common)
+    return old, new.astype(old.dtype)
+
+
+def _append_frame(file_id, partpath):
+    _check_header(file_id, partpath)
+    old = get_csv(file_id)
+    new = pd.read_csv(partpath)
+    if new.empty:
+        return 0
+    columns = {}
+    for name in old.columns:
+        old_column, columns[name] = _coerce_like(old[name], new[name])
+        if old_column is not old[name]:
+            old = old.assign(**{name: old_column})
+    new = pd.DataFrame(columns, index=new.index)[list(old.columns)]
+
+    combined = pd.concat([old, new], ignore_index=True)
+    _append_csv_rows(file_id, partpath)
+    _write_columnar(file_id, combined)
+    _write_profile(file_id, combined, memory=(get_profile(file_id) or {}).get("memory"))
+    _cache.put(file_id, combined)
+    return len(new)
+
+
+def _append_large(file_id, partpath):
+    _check_header(file_id, partpath)
+    dataset_dir = _dataset_path(file_id)
+    parts = [int(name[5:-8]) for name in os.listdir(dataset_dir) if re.fullmatch(r"part-\d+\.parquet", name)]
+    part = os.path.join(dataset_dir, f"part-{max(parts, default=-1) + 1:05d}.parquet")
+    # Written next to the dataset, not inside it, so neither queries nor a
+    # failed conversion ever see a partial part
+    tmp = partpath + ".parquet"
+    try:
+        outofcore.csv_to_parquet(partpath, tmp, schema=get_dataset(file_id).schema)
+        os.replace(tmp, part)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    _append_csv_rows(file_id, partpath)
+    rows = get_profile(file_id)["rows"]
+    return _write_dataset_profile(file_id)["rows"] - rows
+
+
+def _parse_csv(file_id, filepath):
+    try:
+        if os.path.getsize(filepath) > LARGE_FILE_BYTES:
+            df = _ingest_large(file_id, filepath)
+        else:
+            df = _ingest(file_id, filepath)
+    except Exception as e:
+        _set_status(file_id, "failed", str(e))
+        # Let a re-upload of the same bytes try again instead of reusing the failure
+        sha = STATE.get("hash", file_id)
+        if STATE.get("by_hash", sha) == file_id:
+            STATE.delete("by_hash", sha)
+        return
+    if df is not None:
+        _cache.put(file_id, df)
+        if file_id in _cache:
+            _loaded[file_id] = STATE.get("hash", file_id)
+    _set_status(file_id, "ready")
+
+
+def _ingest(file_id, filepath):
+    df, report = _read_compact_csv(file_id, filepath)
+    _write_columnar(file_id, df)
+    _write_profile(file_id, df, memory=_memory_savings(report))
+    return df
+
+
+def _read_compact_csv(file_id, filepath):
+    """Parse a CSV and convert it to compact dtypes (utils/dtypes.py), logging each change."""
+    with metrics.span("parse"):
+        df, report = optimize_dtypes(pd.read_csv(filepath))
+    for change in report:
+        print(f"[INGEST] {file_id} {change['column']}: {change['from']} -> {change['to']} "
+              f"({change['bytes_before']} -> {change['bytes_after']} bytes)")
+    saved = _memory_savings(report)["bytes_saved"]
+    print(f"[INGEST] {file_id}: {len(report)} columns converted, {saved} bytes saved")
+    return df, report
+
+
+def _memory_savings(report):
+    before = sum(change["bytes_before"] for change in report)
+    after = sum(change["bytes_after"] for change in report)
+    return {"columns_converted": len(report), "bytes_saved": before - after}
+
+
+def _ingest_large(file_id, filepath):
+    """
+    Out-of-core ingest: stream the CSV into a Parquet dataset instead of a
+    DataFrame. Nothing is cached in memory; queries run on the dataset.
+    """
+    dataset_dir = _dataset_path(file_id)
+    os.makedirs(dataset_dir + ".tmp", exist_ok=True)
+    with metrics.span("parse"):
+        outofcore.csv_to_parquet(filepath, os.path.join(dataset_dir + ".tmp", "part-00000.parquet"))
+    os.replace(dataset_dir + ".tmp", dataset_dir)
+    _write_dataset_profile(file_id)
+    return None
+
+
+def _dataset_path(file_id):
+    return os.path.join(UPLOAD_DIR, f"{os.path.basename(file_id)}.parquet")
+
+
+def is_large(file_id):
+    """True when file_id is queried out-of-core through a Parquet dataset instead of a DataFrame."""
+    return os.path.isdir(_dataset_path(_store(file_id)))
+
+
+def get_dataset(file_id):
+    return outofcore.open_dataset(_dataset_path(_store(file_id)))
+
+
+def _csv_path(file_id):
+    return os.path.join(UPLOAD_DIR, f"{os.path.basename(file_id)}.csv")
+
+
+def _feather_path(file_id):
+    return os.path.join(UPLOAD_DIR, f"{os.path.basename(file_id)}.feather")
+
+
+def _profile_path(file_id):
+    return os.path.join(UPLOAD_DIR, f"{os.path.basename(file_id)}.profile.json")
+
+
+def _write_profile(file_id, df, memory=None):
+    with metrics.span("profile"):
+        profile = build_profile(df)
+    if memory is not None:
+        profile["memory"] = dict(memory, bytes_in_memory=int(df.memory_usage(deep=True).sum()))
+    STATE.set("profile", file_id, profile)
+    return profile
+
+
+def _write_dataset_profile(file_id):
+    dataset = get_dataset(file_id)
+    with metrics.span("profile"):
+        sample = dataset.head(PROFILE_SAMPLE_ROWS).to_pandas()
+        rows, column_stats = outofcore.parquet_statistics(_dataset_path(file_id))
+        profile = build_dataset_profile(sample, rows, column_stats)
+    STATE.set("profile", file_id, profile)
+    return profile
+
+
+def _write_columnar(file_id, df):
+    """
+    Write a typed Arrow IPC (Feather v2) copy next to the CSV. It is left
+    uncompressed so that reads can memory-map it instead of decoding.
+    """
+    path = _feather_path(file_id)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    feather.write_feather(table, path + ".tmp", compression="uncompressed")
+    os.replace(path + ".tmp", path)
+
+
+_ARROW_STRINGS = {pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}
+
+
+def _read_columnar(file_id, columns=None):
+    table = feather.read_table(_feather_path(file_id), columns=columns, memory_map=True)
+    # split_blocks lets Arrow hand over column buffers without consolidating them;
+    # strings stay Arrow-backed instead of becoming Python objects
+    return table.to_pandas(split_blocks=True, types_mapper=_ARROW_STRINGS.get)
+
+
+def _load_from_disk(file_id):
+    if os.path.exists(_feather_path(file_id)):
+        with metrics.span("load"):
+            return _read_columnar(file_id)
+    filepath = _csv_path(file_id)
+    if not os.path.exists(filepath):
+        return None
+    # Uploads from before the columnar copy existed: parse once and backfill it
+    df, _ = _read_compact_csv(file_id, filepath)
+    _write_columnar(file_id, df)
+    return df
+
+
+def delete_csv(file_id):
+    """
+    Delete an upload. Its stored copy (files and cached frame) is only removed
+    when no other upload refers to it.
+    Returns the number of remaining references, or None for unknown ids.
+    """
+    store = STATE.get("upload", file_id)
+    if store is not None:
+        # Only the first of concurrent deletes of the upload releases its copy
+        if not STATE.add("released", file_id, True, ttl=3600):
+            return None
+        STATE.delete("upload", file_id)
+    else:
+        # Uploads from before per-upload ids: the id is shared and counted in refs
+        store = file_id
+        if STATE.get("refs", store) is None:
+            if not os.path.exists(_csv_path(store)):
+                return None
+            STATE.add("refs", store, 1)  # Uploads from before reference counting
+    return _release(store)
+
+
+def _release(store):
+    """Drop one reference to store, removing it when it was the last; returns the references left."""
+    remaining = STATE.incr("refs", store, -1)
+    if remaining > 0:
+        return remaining
+
+    STATE.delete("refs", store)
+    sha = STATE.get("hash", store)
+    if STATE.get("by_hash", sha) == store:
+        STATE.delete("by_hash", sha)
+    for ns in ("hash", "profile", "status"):
+        STATE.delete(ns, store)
+    _cache.pop(store)
+    _loaded.pop(store, None)
+    for path in (_csv_path(store), _feather_path(store), _profile_path(store)):
+        if os.path.exists(path):
+            os.remove(path)
+    if os.path.isdir(_dataset_path(store)):
+        shutil.rmtree(_dataset_path(store))
+    return 0
+
+
+def get_status(file_id):
+    """Returns (status, error) for an upload; status is None for unknown ids."""
+    store = _store(file_id)
+    entry = STATE.get("status", store)
+    if entry is not None:
+        return entry["status"], entry["error"]
+    # Files uploaded before statuses were shared are still on disk and can be reloaded
+    if os.path.exists(_csv_path(store)):
+        return "ready", None
+    return None, None
+
+
+def get_csv(file_id, columns=None):
+    """
+    Returns the DataFrame for file_id, reloading it from storage/uploads when it
+    was evicted or the process restarted. Blocking; call from a thread or a
+    sandbox worker. With columns (a list of names), a frame that isn't cached
+    is read with only those columns and not cached; a cached frame is returned
+    whole.
+    """
+    store = _store(file_id)
+    if get_status(store)[0] == "processing" or is_large(store):
+        return None
+    # Another worker may have appended to the file since it was cached here
+    version = STATE.get("hash", store)
+    check_version(store, version)
+    df = _cache.get(store)
+    if df is None and columns is not None and os.path.exists(_feather_path(store)):
+        with metrics.span("load"):
+            return _read_columnar(store, list(columns))
+    if df is None:
+        df = _load_from_disk(store)
+        if df is not None:
+            _cache.put(store, df)
+            if store in _cache:
+                _loaded[store] = version
+    return df
+
+
+def get_profile(file_id):
+    """
+    Returns the data profile computed at upload (see utils/profile.py) from the
+    shared state, importing the JSON sidecar older versions wrote, or building
+    it for uploads that predate profiles. Blocking; use load_profile from async code.
+    """
+    store = _store(file_id)
+    profile = STATE.get("profile", store)
+    if profile is None:
+        path = _profile_path(store)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                profile = json.load(f)
+            STATE.set("profile", store, profile)
+        elif is_large(store):
+            profile = _write_dataset_profile(store)
+        else:
+            df = get_csv(store)
+            if df is not None:
+                profile = _write_profile(store, df)
+    return profile
+
+
+async def load_profile(file_id):
+    return await asyncio.to_thread(get_profile, file_id)
+
+
+def _hash_file(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def content_hash(file_id):
+    """sha256 of the stored CSV; computed while streaming, or from disk for older uploads."""
+    return await asyncio.to_thread(_content_hash, file_id)
+
+
+def _content_hash(file_id):
+    store = _store(file_id)
+    sha = STATE.get("hash", store)
+    if sha is None:
+        sha = _hash_file(_csv_path(store))
+        STATE.set("hash", store, sha)
+    return sha
+
+
+def check_version(file_id, version):
+    """
+    Drop the cached frame of file_id if its content changed since it was loaded,
+    e.g. by an append in another process.
+    """
+    store = _store(file_id)
+    if version is not None and store in _loaded and _loaded[store] != version:
+        _cache.pop(store)
+        del _loaded[store]
+
+
+def set_cache_budget(max_bytes):
+    """
+    Resize the frame cache. The API process sets 0 when generated code runs in
+    sandbox workers, which keep their own caches (see utils/pool.py).
+    """
+    _cache.resize(max_bytes)
+    if max_bytes == 0:
+        _loaded.clear()
+
+
+def cache_stats():
+    return _cache.stats()
@@ -1,8 +1,23 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from route import CSVChatAPI
+from utils import metrics
+import time
 
-app = FastAPI(title="AI CSV Analyzer API")
+api = CSVChatAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pre-start the sandbox workers so the first query doesn't pay for imports
+    api.sandbox.start()
+    yield
+    api.sandbox.shutdown()
+
+
+app = FastAPI(title="AI CSV Analyzer API", lifespan=lifespan)
 
 # Allow Streamlit frontend
 app.add_middleware(
@@ -13,6 +28,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-api = CSVChatAPI()
 app.include_router(api.upload)
-app.include_router(api.chat)
\ No newline at end of file
+app.include_router(api.chat)
+
+
+@app.middleware("http")
+async def timing(request: Request, call_next):
+    """
+    Time each request per stage (see utils/metrics.py): sent back as a
+    Server-Timing header and logged when slower than SLOW_QUERY_MS. For
+    streamed responses the header only covers the stages before the stream.
+    """
+    start = time.perf_counter()
+    with metrics.collect() as timings:
+        response = await call_next(request)
+    total = time.perf_counter() - start
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    metrics.observe("http_request_duration_seconds", total, help="Time to the response headers",
+                    method=request.method, route=path)
+    response.headers["Server-Timing"] = metrics.server_timing(timings, total)
+    if metrics.SLOW_QUERY_MS and total * 1000 > metrics.SLOW_QUERY_MS:
+        stages = " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in timings)
+        print(f"[SLOW] {request.method} {request.url.path} {total * 1000:.0f}ms {stages}")
+    return response
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    """Prometheus text format: stage and request duration histograms, LLM token counters."""
+    return metrics.render()
@@ -1,11 +1,17 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import List, Optional
 
 class ChatRequest(BaseModel):
     user_id: str  # Add this field to identify the user/session
     file_id: str  # Existing field (used to locate the uploaded CSV)
     query: str    # The user's natural language query
 
+class BatchChatRequest(BaseModel):
+    user_id: str
+    file_id: str
+    queries: List[str] = Field(..., min_length=1, max_length=500)  # Independent questions about the same file
+    concurrency: Optional[int] = Field(None, ge=1)  # Lower the server's LLM concurrency limit for this batch
+
 class ChatResponse(BaseModel):
     code: str  # The Python code generated by the model
 
@@ -9,4 +9,20 @@ prompt = f"""You are a data analyst. Generate Python pandas code or matplotlib c
                     5. The result should be int or float not never a pandas dafaframe or series.
                     6. Use proper methods and error handling.
                     7. Import numpy always as np always.
-                    """
\ No newline at end of file
+                    8. Always pass observed=True to groupby (some columns are categorical).
+                    """
+
+summary_prompt = """Summarize the earlier part of a conversation between a user and a data analyst that writes pandas code.
+                    Keep the questions asked, column names used, derived variables and conclusions the next answers may rely on.
+                    Answer in at most 150 words of plain text, no code blocks.
+                    """
+
+
+
+large_file_prompt = """The file is too large for pandas, so 'df' is NOT defined. Query it out-of-core instead:
+                    - 'ds' is a pyarrow dataset of the file and 'pc' is pyarrow.compute.
+                    - aggregate(ds, {"total": ("sales", "sum")}, by=["region"], filter=pc.field("year") == 2024) streams the data and returns a small pandas DataFrame.
+                      Functions: sum, mean, min, max, count, count_distinct, stddev, variance, first, last.
+                    - scan(ds, columns=["a", "b"], filter=pc.field("a") > 0) returns a pandas DataFrame of only those columns and rows; always project and filter so it stays small.
+                    Prefer aggregate over scan, and never load every row.
+                    """
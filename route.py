@@ -1,11 +1,25 @@
-from fastapi import APIRouter, UploadFile, File
-from models.schemas import ChatRequest, FeedbackRequest
+from fastapi import APIRouter, UploadFile, File, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from models.schemas import ChatRequest, BatchChatRequest, FeedbackRequest
 import data
 import calls
 from calls import code_gen
-from utils.sand import execute_code
+from utils.pool import SandboxPool, SANDBOX_TIMEOUT
+from utils.scheduler import Saturated, INTERACTIVE, BATCH
+from utils.cache import LRUCache
+from utils import images, metrics, analyze
+from utils import results as result_store
 from prompt import prompt
+import asyncio
+import hashlib
+import pandas as pd
+import pyarrow as pa
+import json
+import os
 import uuid
+from typing import Optional
+
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 256 * 1024**2))
 
 
 class CSVChatAPI:
@@ -13,11 +27,25 @@ class CSVChatAPI:
         # Routers
         self.upload = APIRouter(prefix="/upload", tags=["Upload"])
         self.chat = APIRouter(prefix="/chat", tags=["Chat"])
+        # Generated code runs in worker processes, off the event loop
+        self.sandbox = SandboxPool()
+        # Execution outputs keyed on (file content hash, code hash)
+        self.results = LRUCache(RESULT_CACHE_MAX_BYTES, sizeof=lambda output: len(json.dumps(output, default=str)))
 
 
         # Route bindings
         self.upload.post("/")(self.upload_csv)
+        self.upload.get("/status/{file_id}")(self.upload_status)
+        self.upload.delete("/{file_id}")(self.delete_csv)
+        self.upload.post("/{file_id}/append")(self.append_csv)
+        self.upload.get("/cache/stats")(self.cache_stats)
+        self.upload.get("/profile/{file_id}")(self.get_profile)
         self.chat.post("/")(self.chat_with_csv)
+        self.chat.post("/stream")(self.stream_chat_with_csv)
+        self.chat.post("/batch")(self.batch_chat_with_csv)
+        self.chat.get("/image/{image_id}")(self.get_image)
+        self.chat.get("/result/{result_id}")(self.get_result_page)
+        self.chat.get("/result/{result_id}/arrow")(self.download_result)
         self.chat.get("/history/{user_id}")(self.get_chat_history)
         self.chat.post("/feedback")(self.submit_feedback)
        
@@ -25,31 +53,318 @@ class CSVChatAPI:
 
     async def upload_csv(self, file: UploadFile = File(...)):
         file_id = await data.save_csv(file)
-        return {"message": "File uploaded successfully", "file_id": file_id}
+        status, _ = await asyncio.to_thread(data.get_status, file_id)
+        return {"message": "File uploaded successfully", "file_id": file_id, "status": status}
+
+
+    async def append_csv(self, file_id: str, file: UploadFile = File(...)):
+        """
+        Append the rows of a CSV with the same header to an existing upload,
+        keeping its file_id (and the chat sessions that use it).
+        """
+        await self._require_ready(file_id)
+        try:
+            appended, rows = await data.append_csv(file_id, file)
+        except (ValueError, pd.errors.ParserError, pa.ArrowInvalid) as e:
+            raise HTTPException(status_code=422, detail=f"Rows could not be appended: {e}")
+        return {"message": "Rows appended successfully", "file_id": file_id, "rows_appended": appended, "rows": rows}
+
+
+    async def delete_csv(self, file_id: str):
+        """
+        Release one upload of a file. Identical uploads share storage, so the
+        data is only removed once every upload of it has been deleted.
+        """
+        remaining = await asyncio.to_thread(data.delete_csv, file_id)
+        if remaining is None:
+            raise HTTPException(status_code=404, detail="Unknown file_id")
+        return {"file_id": file_id, "references": remaining, "deleted": remaining == 0}
+
+
+    async def upload_status(self, file_id: str):
+        """
+        Returns the parse status of an upload: 'processing', 'ready' or 'failed'.
+        """
+        status, error = await asyncio.to_thread(data.get_status, file_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Unknown file_id")
+        return {"file_id": file_id, "status": status, "error": error}
+
+
+    async def get_profile(self, file_id: str):
+        """
+        Returns the data profile computed at upload (null counts, cardinality, min/max, top values).
+        """
+        await self._require_ready(file_id)
+        return await data.load_profile(file_id)
+
+
+    async def cache_stats(self):
+        """
+        Returns entry count, memory use and hit/miss/eviction counters of the
+        DataFrame caches of the sandbox workers.
+        """
+        return self.sandbox.cache_stats()
+
+
+    async def _require_ready(self, file_id: str):
+        status, error = await asyncio.to_thread(data.get_status, file_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Unknown file_id")
+        if status != "ready":
+            raise HTTPException(status_code=409, detail=error or f"File is still {status}")
 
 
     async def chat_with_csv(self, request: ChatRequest):
-        df = data.get_csv(request.file_id)
-        bot = code_gen(user_id=request.user_id)
+        await self._require_ready(request.file_id)
+        profile = await data.load_profile(request.file_id)
+        bot = await code_gen.open(request.user_id)
 
-        code, user_id = await bot.generate_code(request.query, df)
-        output = execute_code(code, df)
+        try:
+            code, user_id = await bot.generate_code(request.query, profile)
+            analysis = await self._preflight(bot, request.query, profile, code)
+        except Saturated as e:
+            raise _too_many_requests(e)
+        output = await self._run(request.file_id, analysis)
 
         return {
-            "generated_code": code,
+            "generated_code": analysis["code"],
             "result": output.get("result"),
-            "image": output.get("image"),
+            "result_id": output.get("result_id"),
+            "rows": output.get("rows"),
+            "image_id": output.get("image_id"),
             "error": output.get("error"),
+            "analysis": _analysis_report(analysis),
             "user_id": user_id,
         }
 
 
+    async def stream_chat_with_csv(self, request: ChatRequest):
+        """
+        Server-Sent Events variant of /chat. Emits `session`, then `token` events
+        as the model writes the code, `code` (after the pre-flight analysis, which
+        may have rewritten or regenerated it), `analysis`, `status`, `result` and,
+        when a plot was drawn, `image` (its id, see /chat/image); finishes with
+        `done` (or `error`).
+        """
+        await self._require_ready(request.file_id)
+        # Once the stream has started the status code can't change, so refuse now if the LLM queue is full
+        try:
+            calls.SCHEDULER.check_capacity()
+        except Saturated as e:
+            raise _too_many_requests(e)
+        profile = await data.load_profile(request.file_id)
+        bot = await code_gen.open(request.user_id)
+
+        async def events():
+            yield _sse("session", {"user_id": bot.user_id})
+            try:
+                code = None
+                async for kind, text in bot.stream_code(request.query, profile):
+                    if kind == "token":
+                        yield _sse("token", {"text": text})
+                    else:
+                        code = text
+                analysis = await self._preflight(bot, request.query, profile, code)
+                yield _sse("code", {"generated_code": analysis["code"]})
+                yield _sse("analysis", _analysis_report(analysis))
+
+                yield _sse("status", {"stage": "executing"})
+                output = await self._run(request.file_id, analysis)
+                yield _sse("result", {key: output.get(key) for key in ("result", "result_id", "rows", "error")})
+                if output.get("image_id") is not None:
+                    yield _sse("image", {"image_id": output.get("image_id")})
+            except Exception as e:
+                yield _sse("error", {"error": str(e)})
+                return
+            yield _sse("done", {"user_id": bot.user_id})
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+
+    async def batch_chat_with_csv(self, request: BatchChatRequest):
+        """
+        Answer several independent queries about one file. Code generation runs
+        concurrently up to the configured limit and each query is executed in the
+        sandbox as soon as its code is ready. A failing query is reported in its
+        own entry and does not fail the batch.
+        """
+        await self._require_ready(request.file_id)
+        profile = await data.load_profile(request.file_id)
+        bot = await code_gen.open(request.user_id)
+        concurrency = min(request.concurrency or calls.LLM_BATCH_CONCURRENCY, calls.LLM_BATCH_CONCURRENCY)
+        # Shared by generation and regeneration, so slow answers sent back to the model stay within the limit
+        semaphore = asyncio.Semaphore(concurrency)
+
+        results = [{"query": q, "generated_code": None, "result": None, "result_id": None, "rows": None, "image_id": None, "error": None, "analysis": None} for q in request.queries]
+        executions = {}
+
+        async def check_and_run(index, code):
+            analysis = await self._preflight(bot, request.queries[index], profile, code, BATCH, semaphore)
+            results[index]["generated_code"] = analysis["code"]
+            results[index]["analysis"] = _analysis_report(analysis)
+            return await self._run(request.file_id, analysis)
+
+        async for index, code in bot.generate_batch(request.queries, profile, semaphore=semaphore):
+            if isinstance(code, Exception):
+                results[index]["error"] = f"Code generation failed: {code}"
+            else:
+                results[index]["generated_code"] = code
+                executions[index] = asyncio.create_task(check_and_run(index, code))
+
+        outputs = await asyncio.gather(*executions.values(), return_exceptions=True)
+        for index, output in zip(executions, outputs):
+            if isinstance(output, Exception):
+                results[index]["error"] = str(output)
+            else:
+                results[index].update({key: output.get(key) for key in ("result", "result_id", "rows", "image_id", "error")})
+
+        return {
+            "user_id": bot.user_id,
+            "file_id": request.file_id,
+            "results": results,
+            "failed": sum(r["error"] is not None for r in results),
+        }
+
+
+    async def _preflight(self, bot, query, profile, code, priority=INTERACTIVE, semaphore=None):
+        """
+        Static analysis of generated code before it runs (utils/analyze.py).
+        Row-wise patterns that are safe to vectorize are rewritten; code still
+        estimated to be slow is sent back to the model once with a hint.
+        The code that will run is cached for the query in place of the original.
+        """
+        with metrics.span("analyze"):
+            analysis = analyze.analyze(code, profile)
+        for finding in analysis["findings"]:
+            action = "rewritten" if finding["rewritten"] else "flagged"
+            metrics.inc("generated_code_findings_total", help="Slow patterns found in generated code", pattern=finding["pattern"], action=action)
+        analysis["regenerated"] = False
+        if analysis["hint"] is not None:
+            print(f"[ANALYZE] Estimated {analysis['estimated_seconds']}s, asking for vectorized code: {query}")
+            code = await bot.regenerate(query, profile, code, analysis["hint"], priority, semaphore)
+            with metrics.span("analyze"):
+                analysis = analyze.analyze(code, profile)
+            analysis["regenerated"] = True
+        if analysis["regenerated"] or analysis["code"] != code:
+            calls.CODE_CACHE.put(query, profile["columns"], profile["dtypes"], analysis["code"], profile.get("engine"))
+        return analysis
+
+
+    async def _run(self, file_id: str, analysis: dict):
+        """Execute analysed code, unless its loops over df are estimated to overrun the sandbox timeout."""
+        if analysis["df_seconds"] > SANDBOX_TIMEOUT:
+            metrics.inc("generated_code_rejected_total", help="Generated code not run because its estimated cost exceeds SANDBOX_TIMEOUT")
+            problems = "; ".join(f"line {f['line']}: {f['message']}" for f in analysis["findings"] if not f["rewritten"] and f["frame"] == "df")
+            error = f"Generated code was not run: estimated {analysis['df_seconds']:.0f}s exceeds the {SANDBOX_TIMEOUT:.0f}s limit ({problems})"
+            return {"result": None, "result_id": None, "rows": None, "image_id": None, "error": error}
+        return await self.execute(file_id, analysis["code"], analysis["columns"])
+
+
+    async def execute(self, file_id: str, code: str, columns=None):
+        """
+        Run code against a file, reusing the previous output when the same code
+        already ran on the same file content. columns are the ones the code
+        reads (from the pre-flight analysis), so a worker without the frame
+        cached only loads those.
+        """
+        version = await data.content_hash(file_id)
+        key = (version, hashlib.sha256(code.encode("utf-8")).hexdigest())
+        output = self.results.get(key)
+        if output is not None and not _handles_exist(output):
+            # The stored plot or table expired (IMAGE_TTL / RESULT_TTL); run again for fresh ids
+            self.results.pop(key)
+            output = None
+        if output is None:
+            with metrics.span("sandbox"):
+                output = await self.sandbox.run(file_id, code, version, columns)
+            for stage, seconds in output.pop("timings", []):
+                metrics.record(stage, seconds)
+            # Errors (timeouts in particular) are not cached so they can be retried
+            if output.get("error") is None:
+                self.results.put(key, output)
+        return output
+
+
+    async def get_image(
+        self,
+        image_id: str,
+        request: Request,
+        format: str = "png",
+        dpi: int = Query(images.DEFAULT_DPI, ge=10, le=images.MAX_DPI),
+        width: Optional[int] = Query(None, ge=16, le=4096),
+    ):
+        """
+        Raw bytes of a plot returned by /chat as image_id. format is png, svg
+        or webp; width caps the longer side in pixels for thumbnails. Responses
+        carry an ETag and may be cached by clients.
+        """
+        if format not in images.FORMATS:
+            raise HTTPException(status_code=422, detail=f"format must be one of {sorted(images.FORMATS)}")
+        if not images.exists(image_id):
+            raise HTTPException(status_code=404, detail="Unknown or expired image_id")
+        format, dpi, width = images.variant(image_id, format, dpi, width)
+        etag = images.etag(image_id, format, dpi, width)
+        headers = {"ETag": etag, "Cache-Control": f"private, max-age={images.IMAGE_TTL}"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        try:
+            content = await asyncio.to_thread(images.render, image_id, format, dpi, width)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Unknown or expired image_id")
+        return Response(content, media_type=images.FORMATS[format], headers=headers)
+
+
+    async def get_result_page(
+        self,
+        result_id: str,
+        offset: int = Query(0, ge=0),
+        limit: int = Query(1000, ge=1, le=result_store.RESULT_PAGE_MAX_ROWS),
+    ):
+        """
+        Page through a table result whose preview was cut off in /chat.
+        Pass next_offset back as offset until it is null.
+        """
+        if not result_store.exists(result_id):
+            raise HTTPException(status_code=404, detail="Unknown or expired result_id")
+        try:
+            page, rows = await asyncio.to_thread(result_store.read_page, result_id, offset, limit)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Unknown or expired result_id")
+        end = min(offset + limit, rows)
+        return {
+            "result_id": result_id,
+            "rows": rows,
+            "offset": offset,
+            "next_offset": end if end < rows else None,
+            **page,
+        }
+
+
+    async def download_result(self, result_id: str):
+        """
+        The whole table result as an Arrow IPC stream (pyarrow.ipc.open_stream,
+        pandas via read_all().to_pandas()), sent one record batch at a time.
+        """
+        if not result_store.exists(result_id):
+            raise HTTPException(status_code=404, detail="Unknown or expired result_id")
+        return StreamingResponse(
+            result_store.stream_arrow(result_id),
+            media_type="application/vnd.apache.arrow.stream",
+            headers={"Content-Disposition": f'attachment; filename="{result_id}.arrows"'},
+        )
+
+
     async def get_chat_history(self, user_id: str):
         """
         Returns the chat history for a specific user_id.
         """
-        history, user_id = calls.get_user_history(user_id)
-        return {"user_id": user_id, "history": history}
+        history, user_id = await asyncio.to_thread(calls.get_user_history, user_id)
+        return {"user_id": user_id, "history": {"messages": await history.aget_messages()}}
 
   
     async def submit_feedback(self, request: FeedbackRequest):
@@ -58,7 +373,25 @@ class CSVChatAPI:
         feedback can be: 'thumbs_up', 'thumbs_down', or None
         """
         print(f"[FEEDBACK] Received feedback from user {request.query}: {request.code}, {request.feedback}")
-        calls.add_feedback(request.query, request.code, request.feedback)
+        await asyncio.to_thread(calls.add_feedback, request.query, request.code, request.feedback)
         return {"message": "Feedback received", "feedback": request.feedback}
 
 
+def _handles_exist(output: dict) -> bool:
+    """True when the image_id and result_id of a memoized output can still be fetched."""
+    if output.get("image_id") is not None and not images.exists(output["image_id"]):
+        return False
+    return output.get("result_id") is None or result_store.exists(output["result_id"])
+
+
+def _analysis_report(analysis: dict) -> dict:
+    """The parts of a pre-flight analysis returned to clients."""
+    return {key: analysis[key] for key in ("findings", "estimated_seconds", "regenerated")}
+
+
+def _too_many_requests(e: Saturated) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
@@ -0,0 +1,420 @@
+import ast
+import functools
+import math
+import os
+import re
+import pandas as pd
+
+ANALYZE_REGENERATE_SECONDS = float(os.getenv("ANALYZE_REGENERATE_SECONDS", 2.0))  # Slower estimates are sent back to the LLM
+COMPILED_CACHE_SIZE = int(os.getenv("COMPILED_CACHE_SIZE", 512))  # Code objects (and analyses) kept per process
+DEFAULT_LOOP_ITERATIONS = 100  # Assumed when the number of iterations can't be read from the code or profile
+DEFAULT_FRAME_ROWS = 1000  # Assumed for frames other than the sandbox's df, whose size is unknown
+
+# Rough seconds per row, measured on a 200k-row frame with mixed dtypes
+ROW_COSTS = {
+    "iterrows": 4e-5,
+    "itertuples": 1e-6,
+    "apply_rows": 1e-5,
+    "loop_filter": 5e-9,  # Per row and per iteration of the enclosing loop
+}
+MESSAGES = {
+    "iterrows": "row-by-row loop over {name}.iterrows()",
+    "itertuples": "row-by-row loop over {name}.itertuples()",
+    "apply_rows": "{name}.apply(..., axis=1) calls a Python function per row",
+    "loop_filter": "{name} is filtered with a boolean mask inside a loop; each iteration scans every row",
+}
+_NUMERIC = re.compile(r"^(u?int|float|Int|UInt|Float)(\d*)$")
+# Compacted dtypes (utils/dtypes.py) are widened in rewritten arithmetic, where
+# the row-wise original computed on Python/64-bit scalars and could not overflow
+_WIDE = {"int": "int64", "uint": "int64", "float": "float64", "Int": "Int64", "UInt": "Int64", "Float": "Float64"}
+_ARITHMETIC = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_COMPARE = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+_TUPLE_FIELD = re.compile(r"^(Index|_\d+)$")  # itertuples fields that are not columns
+
+
+def _numeric_columns(dtypes):
+    """{column: dtype to widen to, or None} for the numeric columns of a profile."""
+    numeric = {}
+    for column, dtype in dtypes.items():
+        match = _NUMERIC.match(str(dtype))
+        if match:
+            numeric[column] = None if match.group(2) in ("", "64") else _WIDE[match.group(1)]
+    return numeric
+
+
+def _name(node):
+    return node.id if isinstance(node, ast.Name) else ast.unparse(node)
+
+
+def _column(node, row):
+    """
+    Column name when node is row['col'] or row.col, else None. row.size,
+    row.name and other Series attributes are not columns even when one has
+    that name.
+    """
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == row:
+        if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+            return node.slice.value
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == row \
+            and not hasattr(pd.Series, node.attr):
+        return node.attr
+    return None
+
+
+def _frame_column(node):
+    """(frame, column) when node is frame['col'] or frame.col, else None."""
+    if isinstance(node, (ast.Subscript, ast.Attribute)) and isinstance(node.value, ast.Name):
+        column = _column(node, node.value.id)
+        if column is not None:
+            return node.value.id, column
+    return None
+
+
+class _RowExpression(ast.NodeTransformer):
+    """
+    Turns an expression over one row (row['a'] * 2 + row.b) into the same
+    expression over whole columns of frame. Only arithmetic, single comparisons,
+    abs/round and constants on numeric columns are accepted; anything else
+    leaves ok False.
+    """
+
+    def __init__(self, row, frame, numeric):
+        self.row, self.frame, self.numeric = row, frame, numeric
+        self.columns = set()
+        self.ok = True
+
+    def visit(self, node):
+        column = _column(node, self.row)
+        if column is not None:
+            if column not in self.numeric:
+                self.ok = False
+            self.columns.add(column)
+            series = ast.Subscript(value=ast.Name(id=self.frame, ctx=ast.Load()), slice=ast.Constant(column), ctx=ast.Load())
+            if self.numeric.get(column) is None:
+                return series
+            return ast.Call(func=ast.Attribute(value=series, attr="astype", ctx=ast.Load()), args=[ast.Constant(self.numeric[column])], keywords=[])
+        if isinstance(node, ast.BinOp) and isinstance(node.op, _ARITHMETIC):
+            pass
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            pass
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], _COMPARE):
+            pass
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ("abs", "round") and not node.keywords:
+            return ast.Call(func=node.func, args=[self.visit(arg) for arg in node.args], keywords=[])
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return node
+        elif not isinstance(node, (ast.operator, ast.unaryop, ast.cmpop)):
+            self.ok = False
+            return node
+        return self.generic_visit(node)
+
+
+def _vectorize(expr, row, frame, numeric):
+    """Column-wise source for a row expression, or None when it is not safe to rewrite."""
+    transformer = _RowExpression(row, frame, numeric)
+    vectorized = transformer.visit(ast.parse(ast.unparse(expr), mode="eval").body)
+    if not transformer.ok or not transformer.columns:
+        return None
+    return ast.unparse(vectorized)
+
+
+class _Inspector(ast.NodeVisitor):
+    def __init__(self, tree, columns, numeric, unique):
+        self.columns, self.numeric, self.unique = columns, numeric, unique
+        self.findings = []
+        self.replacements = []  # (node, new source)
+        self._loops = []  # (target names, iterations) of the enclosing loops
+        self._handled = set()  # ids of calls already covered by a rewritten loop
+        self._loads = {}
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+                self._loads[node.id] = self._loads.get(node.id, 0) + 1
+
+    def _add(self, pattern, node, name, rewritten=False):
+        self.findings.append({
+            "pattern": pattern,
+            "frame": name,
+            "line": node.lineno,
+            "message": MESSAGES[pattern].format(name=name),
+            "rewritten": rewritten,
+            "iterations": math.prod(iterations for _, iterations in self._loops),
+        })
+
+    def _iterations(self, node):
+        """Iterations of `for ... in node`: range(n), a literal list, or the cardinality of df['col'].unique()."""
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)) and not any(isinstance(e, ast.Starred) for e in node.elts):
+            return max(len(node.elts), 1)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "range":
+            if len(node.args) == 1 and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, int):
+                return max(node.args[0].value, 1)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in ("unique", "drop_duplicates"):
+            frame_column = _frame_column(node.func.value)
+            if frame_column is not None and frame_column[1] in self.unique:
+                return max(self.unique[frame_column[1]], 1)
+        return DEFAULT_LOOP_ITERATIONS
+
+    def _targets(self, target):
+        return {node.id for node in ast.walk(target) if isinstance(node, ast.Name)}
+
+    def visit_For(self, node):
+        if self._rewrite_loop(node):
+            return
+        self.visit(node.iter)
+        self._loops.append((self._targets(node.target), self._iterations(node.iter)))
+        for child in node.body + node.orelse:
+            self.visit(child)
+        self._loops.pop()
+
+    def visit_While(self, node):
+        self._loops.append((set(), DEFAULT_LOOP_ITERATIONS))
+        self.generic_visit(node)
+        self._loops.pop()
+
+    def _visit_comprehension(self, node):
+        depth = len(self._loops)
+        for generator in node.generators:
+            self.visit(generator.iter)
+            self._loops.append((self._targets(generator.target), self._iterations(generator.iter)))
+            for condition in generator.ifs:
+                self.visit(condition)
+        for child in (node.key, node.value) if isinstance(node, ast.DictComp) else (node.elt,):
+            self.visit(child)
+        del self._loops[depth:]
+
+    visit_ListComp = visit_SetComp = visit_GeneratorExp = visit_DictComp = _visit_comprehension
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute) and id(node) not in self._handled:
+            frame = _name(node.func.value)
+            if node.func.attr in ("iterrows", "itertuples"):
+                self._add(node.func.attr, node, frame)
+            elif node.func.attr == "apply" and any(
+                k.arg == "axis" and isinstance(k.value, ast.Constant) and k.value.value in (1, "columns") for k in node.keywords
+            ):
+                rewritten = self._rewrite_apply(node)
+                self._add("apply_rows", node, frame, rewritten)
+                if rewritten:
+                    return
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        # df[df['col'] == value] or df.loc[...] with a mask that depends on a loop variable
+        base = node.value.value if isinstance(node.value, ast.Attribute) and node.value.attr == "loc" else node.value
+        if self._loops and isinstance(base, ast.Name):
+            mask = node.slice.elts[0] if isinstance(node.slice, ast.Tuple) and node.slice.elts else node.slice
+            names = {n.id for n in ast.walk(mask) if isinstance(n, ast.Name)}
+            loop_names = set().union(*(targets for targets, _ in self._loops))
+            if any(isinstance(n, ast.Compare) for n in ast.walk(mask)) and base.id in names and names & loop_names:
+                self._add("loop_filter", node, base.id)
+        self.generic_visit(node)
+
+    def _rewrite_apply(self, node):
+        """frame.apply(lambda row: <expression>, axis=1) -> the expression on whole columns."""
+        if not isinstance(node.func.value, ast.Name) or len(node.args) != 1 or len(node.keywords) != 1:
+            return False
+        function = node.args[0]
+        if not isinstance(function, ast.Lambda) or len(function.args.args) != 1 or function.args.vararg or function.args.kwarg:
+            return False
+        vectorized = _vectorize(function.body, function.args.args[0].arg, node.func.value.id, self.numeric)
+        if vectorized is None:
+            return False
+        self.replacements.append((node, f"({vectorized})"))
+        return True
+
+    def _rewrite_loop(self, node):
+        """
+        Accumulating loops over iterrows()/itertuples():
+
+            for _, row in df.iterrows():        ->  total += df['a'].sum(skipna=False)
+                total += row['a']
+            for _, row in df.iterrows():        ->  n += int((df['b'] > 5).fillna(False).sum())
+                if row['b'] > 5:
+                    n += 1
+        """
+        call = node.iter
+        if node.orelse or len(node.body) != 1 or not isinstance(call, ast.Call) or call.args or call.keywords:
+            return False
+        if not isinstance(call.func, ast.Attribute) or not isinstance(call.func.value, ast.Name):
+            return False
+        frame = call.func.value.id
+        if call.func.attr == "iterrows" and isinstance(node.target, ast.Tuple) and len(node.target.elts) == 2 \
+                and all(isinstance(e, ast.Name) for e in node.target.elts):
+            index, row = node.target.elts[0].id, node.target.elts[1].id
+        elif call.func.attr == "itertuples" and isinstance(node.target, ast.Name):
+            index, row = None, node.target.id
+        else:
+            return False
+
+        def row_column(node):
+            # itertuples rows are namedtuples: attributes only, and Index/_N aren't columns
+            if index is None and (not isinstance(node, ast.Attribute) or _TUPLE_FIELD.match(node.attr)):
+                return None
+            column = _column(node, row)
+            return column if column in self.columns else None
+
+        # The loop variables must not be read after the loop
+        loop_loads = {}
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load):
+                loop_loads[n.id] = loop_loads.get(n.id, 0) + 1
+        if any(self._loads.get(v, 0) > loop_loads.get(v, 0) for v in (index, row) if v is not None):
+            return False
+
+        statement, mask = node.body[0], None
+        if isinstance(statement, ast.If) and not statement.orelse and len(statement.body) == 1:
+            test = statement.test
+            if not (isinstance(test, ast.Compare) and len(test.ops) == 1 and isinstance(test.ops[0], _COMPARE)):
+                return False
+            column = row_column(test.left)
+            value = test.comparators[0]
+            if column is None or not isinstance(value, ast.Constant) or _column(value, row) is not None:
+                return False
+            compare = ast.Compare(left=ast.Subscript(value=ast.Name(id=frame, ctx=ast.Load()), slice=ast.Constant(column), ctx=ast.Load()),
+                                  ops=test.ops, comparators=[value])
+            mask = f"({ast.unparse(compare)}).fillna(False)"
+            statement = statement.body[0]
+
+        # total += <value> or total = total + <value>
+        if isinstance(statement, ast.AugAssign) and isinstance(statement.op, ast.Add) and isinstance(statement.target, ast.Name):
+            target, value = statement.target.id, statement.value
+        elif isinstance(statement, ast.Assign) and len(statement.targets) == 1 and isinstance(statement.targets[0], ast.Name) \
+                and isinstance(statement.value, ast.BinOp) and isinstance(statement.value.op, ast.Add) \
+                and isinstance(statement.value.left, ast.Name) and statement.value.left.id == statement.targets[0].id:
+            target, value = statement.targets[0].id, statement.value.right
+        else:
+            return False
+        if target in (index, row):
+            return False
+
+        if isinstance(value, ast.Constant) and value.value == 1:
+            total = f"int({mask}.sum())" if mask else f"len({frame})"
+        else:
+            column = row_column(value)
+            if column is None or column not in self.numeric:
+                return False
+            selected = f"{frame}.loc[{mask}, {column!r}]" if mask else f"{frame}[{column!r}]"
+            total = f"{selected}.sum(skipna=False)"
+        self._handled.add(id(call))
+        self._add(call.func.attr, call, frame, rewritten=True)
+        self.replacements.append((node, f"{target} += {total}"))
+        return True
+
+
+def _names(node):
+    """['a', 'b'] when node is 'a' or ['a', 'b'] (a list or tuple of strings), else None."""
+    elements = node.elts if isinstance(node, (ast.List, ast.Tuple)) else [node]
+    if all(isinstance(e, ast.Constant) and isinstance(e.value, str) for e in elements):
+        return [e.value for e in elements]
+    return None
+
+
+def _frame_columns(tree, columns):
+    """
+    The columns of df that the code reads, in profile order, when every use of
+    df is df['col'], df[['a', 'b']], df.col or df.groupby(keys)[cols]; None
+    when df is used in any other way (result = df, df.head(), df[mask]) and
+    may need all of them.
+    """
+    parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+    used = set()
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Name) and node.id == "df"):
+            continue
+        parent = parents.get(node)
+        names = None
+        if not isinstance(node.ctx, ast.Load):
+            return None
+        if isinstance(parent, ast.Subscript) and parent.value is node:
+            names = _names(parent.slice)
+        elif isinstance(parent, ast.Attribute) and parent.attr == "groupby":
+            call, selection = parents.get(parent), parents.get(parents.get(parent))
+            if isinstance(call, ast.Call) and call.func is parent and len(call.args) == 1 \
+                    and all(k.arg in ("observed", "sort", "dropna") for k in call.keywords) \
+                    and isinstance(selection, ast.Subscript) and selection.value is call:
+                keys, selected = _names(call.args[0]), _names(selection.slice)
+                names = keys + selected if keys is not None and selected is not None else None
+        elif isinstance(parent, ast.Attribute) and not hasattr(pd.DataFrame, parent.attr):
+            names = [parent.attr]
+        if names is None or not set(names) <= set(columns):
+            return None
+        used.update(names)
+    if not used:
+        return None
+    return tuple(column for column in columns if column in used)
+
+
+def _apply_replacements(code, replacements):
+    """Splice new source over the nodes' spans (byte offsets, as reported by ast), last first."""
+    lines = code.encode("utf-8").splitlines(keepends=True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    source = code.encode("utf-8")
+    for node, text in sorted(replacements, key=lambda r: (r[0].lineno, r[0].col_offset), reverse=True):
+        start = offsets[node.lineno - 1] + node.col_offset
+        end = offsets[node.end_lineno - 1] + node.end_col_offset
+        source = source[:start] + text.encode("utf-8") + source[end:]
+    return source.decode("utf-8")
+
+
+@functools.lru_cache(maxsize=COMPILED_CACHE_SIZE)
+def _inspect(code, columns, numeric, unique):
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code, (), None  # The sandbox reports it
+    inspector = _Inspector(tree, set(columns), dict(numeric), dict(unique))
+    inspector.visit(tree)
+    rewritten = _apply_replacements(code, inspector.replacements) if inspector.replacements else code
+    used = _frame_columns(ast.parse(rewritten) if inspector.replacements else tree, columns)
+    return rewritten, tuple(inspector.findings), used
+
+
+def analyze(code: str, profile: dict) -> dict:
+    """
+    Static pre-flight check of generated code against the file's profile (see
+    utils/profile.py). Row-wise patterns (iterrows/itertuples loops,
+    apply(axis=1), boolean filtering inside loops) are reported with an
+    estimated cost; the ones that are safe to vectorize are rewritten. Only
+    loops over the sandbox's df are charged the file's row count; other frames
+    are assumed to have DEFAULT_FRAME_ROWS. Returns {"code", "findings",
+    "estimated_seconds", "df_seconds", "columns", "hint"}: columns are the
+    ones the code reads, so only they need loading (None: all of them);
+    df_seconds is the part of the
+    estimate spent on df, the only part known well enough to refuse to run the
+    code on. hint is a request for vectorized code to send back to the model,
+    set when the code left after rewriting is estimated to take over
+    ANALYZE_REGENERATE_SECONDS.
+    """
+    columns = tuple(profile.get("columns", ()))
+    numeric = tuple(_numeric_columns(profile.get("dtypes", {})).items())
+    unique = tuple((entry["name"], entry["unique"]) for entry in profile.get("stats", []) if "unique" in entry)
+    rewritten, findings, used = _inspect(code, columns, numeric, unique)
+    rows = profile.get("rows", 0)
+
+    findings = [dict(f) for f in findings]
+    seconds = df_seconds = 0.0
+    for finding in findings:
+        frame_rows = rows if finding["frame"] == "df" else DEFAULT_FRAME_ROWS
+        cost = 0.0 if finding["rewritten"] else ROW_COSTS[finding["pattern"]] * frame_rows * finding["iterations"]
+        finding["estimated_seconds"] = round(cost, 3)
+        seconds += cost
+        if finding["frame"] == "df":
+            df_seconds += cost
+
+    hint = None
+    if seconds > ANALYZE_REGENERATE_SECONDS:
+        problems = "\n".join(f"- line {f['line']}: {f['message']}" for f in findings if not f["rewritten"])
+        hint = (
+            f"This code is too slow for {rows} rows (estimated {seconds:.1f}s):\n{problems}\n"
+            "Rewrite it with vectorized pandas operations (column arithmetic, boolean masks, "
+            "groupby/agg, merge) instead of row-by-row loops, iterrows, itertuples or apply(axis=1). "
+            "Generate ONLY the code."
+        )
+    return {"code": rewritten, "findings": findings, "estimated_seconds": round(seconds, 3), "df_seconds": round(df_seconds, 3), "columns": used, "hint": hint}
+
+
+@functools.lru_cache(maxsize=COMPILED_CACHE_SIZE)
+def compile_code(code: str):
+    """Compiled code object for exec, cached so repeated queries skip parsing and compiling."""
+    return compile(code, "<generated>", "exec")
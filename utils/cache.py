@@ -0,0 +1,79 @@
+from collections import OrderedDict
+import sys
+import threading
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by the total size of its values.
+    sizeof(value) returns the number of bytes a value accounts for.
+    """
+
+    def __init__(self, max_bytes: int, sizeof=sys.getsizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # {key: (value, nbytes)}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.current_bytes -= self._data.pop(key)[1]
+            # A value larger than the whole budget is not cached at all
+            if nbytes > self.max_bytes:
+                return
+            self._data[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._data.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def resize(self, max_bytes: int):
+        """Change the budget, evicting least recently used values until they fit."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._data.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, nbytes = self._data.pop(key)
+            self.current_bytes -= nbytes
+            return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
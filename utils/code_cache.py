@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+CODE_CACHE_PATH = os.getenv("CODE_CACHE_PATH", "storage/code_cache.sqlite")
+CODE_CACHE_MAX_ENTRIES = int(os.getenv("CODE_CACHE_MAX_ENTRIES", 10000))
+
+
+def normalize_query(query: str) -> str:
+    """Lower-case, collapse whitespace and drop trailing punctuation."""
+    return re.sub(r"\s+", " ", query).strip().rstrip("?.!").strip().lower()
+
+
+def schema_fingerprint(columns, dtypes, engine=None) -> str:
+    """Hash of the column names and dtypes, in column order, and of the query engine if not pandas."""
+    schema = [[str(c), str(dtypes[c])] for c in columns]
+    payload = json.dumps(schema if engine is None else [engine, schema])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CodeCache:
+    """
+    Persistent (SQLite) cache of generated code keyed on the normalised query and
+    the schema fingerprint. Entries with thumbs_up feedback are preferred: they
+    are not overwritten and are evicted last. thumbs_down removes an entry.
+    """
+
+    def __init__(self, path=CODE_CACHE_PATH, max_entries=CODE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS code_cache (
+                    query_key TEXT NOT NULL,
+                    schema_key TEXT NOT NULL,
+                    code TEXT NOT NULL,
+                    preferred INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (query_key, schema_key)
+                )"""
+            )
+
+    def get(self, query, columns, dtypes, engine=None):
+        key = (normalize_query(query), schema_fingerprint(columns, dtypes, engine))
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT code FROM code_cache WHERE query_key = ? AND schema_key = ?", key
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE code_cache SET last_used = ? WHERE query_key = ? AND schema_key = ?",
+                (time.time(), *key),
+            )
+        return row[0]
+
+    def put(self, query, columns, dtypes, code, engine=None):
+        key = (normalize_query(query), schema_fingerprint(columns, dtypes, engine))
+        with self._lock, self._conn:
+            self._conn.execute(
+                """INSERT INTO code_cache (query_key, schema_key, code, last_used) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (query_key, schema_key) DO UPDATE
+                   SET code = excluded.code, last_used = excluded.last_used WHERE preferred = 0""",
+                (*key, code, time.time()),
+            )
+            # Evict least recently used entries, non-preferred ones first
+            self._conn.execute(
+                """DELETE FROM code_cache WHERE rowid IN (
+                       SELECT rowid FROM code_cache ORDER BY preferred DESC, last_used DESC
+                       LIMIT -1 OFFSET ?)""",
+                (self.max_entries,),
+            )
+
+    def feedback(self, query, code, feedback):
+        """Apply thumbs_up / thumbs_down feedback to every cached entry for this query and code."""
+        query_key = normalize_query(query)
+        with self._lock, self._conn:
+            if feedback == "thumbs_up":
+                self._conn.execute(
+                    "UPDATE code_cache SET preferred = 1 WHERE query_key = ? AND code = ?",
+                    (query_key, code),
+                )
+            elif feedback == "thumbs_down":
+                self._conn.execute(
+                    "DELETE FROM code_cache WHERE query_key = ? AND code = ?",
+                    (query_key, code),
+                )
@@ -0,0 +1,119 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+
+# Strings become categorical only when genuinely low-cardinality: at most
+# CATEGORY_MAX_VALUES distinct values and under CATEGORY_MAX_RATIO of the rows.
+# Groupby on categoricals yields every combination of categories unless
+# observed=True, so high-cardinality keys would explode results.
+CATEGORY_MAX_VALUES = int(os.getenv("DTYPE_CATEGORY_MAX_VALUES", 64))
+CATEGORY_MAX_RATIO = 0.05
+DATETIME_SAMPLE = 1000  # Values checked before trying to parse a string column as dates
+# Narrowest integer width used when downcasting. Below 32 bits, ordinary
+# arithmetic in generated code (df.a * df.b) starts to overflow silently.
+# Narrower widths are also only used when the square of the largest value
+# still fits, so products and sums of the column don't wrap around.
+MIN_INT_BITS = int(os.getenv("DTYPE_MIN_INT_BITS", 32))
+# float32 holds each value of a column exactly but changes sums and means
+# (accumulated in float32), so it is only used when asked for
+FLOAT32 = os.getenv("DTYPE_FLOAT32", "0") == "1"
+_DATE_LIKE = re.compile(r"^\s*\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}")
+
+
+def _looks_like_dates(values: pd.Series) -> bool:
+    sample = values.dropna().head(DATETIME_SAMPLE).astype(str)
+    return len(sample) > 0 and bool(sample.str.match(_DATE_LIKE).all())
+
+
+def _compact_strings(s: pd.Series) -> pd.Series:
+    # Mixed-type object columns are left alone
+    if pd.api.types.infer_dtype(s, skipna=True) != "string":
+        return s
+    if _looks_like_dates(s):
+        parsed = pd.to_datetime(s, errors="coerce")
+        if parsed.isna().sum() == s.isna().sum():
+            return parsed
+    unique = s.nunique(dropna=True)
+    if unique <= CATEGORY_MAX_VALUES and unique < CATEGORY_MAX_RATIO * len(s):
+        return s.astype("category")
+    return s.astype(pd.StringDtype("pyarrow"))
+
+
+def _int_fits(bound, dtype) -> bool:
+    return np.dtype(dtype).itemsize == 8 or bound * bound <= np.iinfo(dtype).max
+
+
+def _compact_integers(s: pd.Series) -> pd.Series:
+    if s.dtype != np.int64 or s.empty:
+        return s
+    bound = max(abs(int(s.min())), abs(int(s.max())))
+    for bits in (8, 16, 32):
+        if bits >= MIN_INT_BITS and _int_fits(bound, f"int{bits}"):
+            return s.astype(f"int{bits}")
+    return s
+
+
+def _compact_floats(s: pd.Series) -> pd.Series:
+    if not FLOAT32:
+        return s
+    narrow = s.astype(np.float32)
+    # Only when every value is stored exactly
+    if ((narrow.astype(np.float64) == s) | s.isna()).all():
+        return narrow
+    return s
+
+
+def fits(s: pd.Series, dtype) -> bool:
+    """
+    Whether the numbers in s can be stored as dtype (a numpy integer or float
+    dtype, as chosen by optimize_dtypes) under the same rules: integers within
+    the headroom, floats exactly.
+    """
+    dtype = np.dtype(dtype)
+    values = s.dropna()
+    if dtype.kind in "iu":
+        if s.isna().any() or values.dtype.kind not in "iu":
+            return False
+        return values.empty or _int_fits(max(abs(int(values.min())), abs(int(values.max()))), dtype)
+    if dtype.kind == "f":
+        return bool((values.astype(dtype).astype(np.float64) == values).all())
+    return False
+
+
+def _dtype_name(dtype) -> str:
+    if isinstance(dtype, pd.StringDtype):
+        return f"string[{dtype.storage}]"
+    return str(dtype)
+
+
+def optimize_dtypes(df: pd.DataFrame):
+    """
+    Convert columns to compact dtypes: dates to datetime64, low-cardinality
+    strings to category, other strings to Arrow-backed strings, integers downcast to
+    at least MIN_INT_BITS, and floats to float32 when DTYPE_FLOAT32=1 and each
+    value fits exactly.
+    Returns the new frame and a per-column report of the changes.
+    """
+    columns = {}
+    report = []
+    for name in df.columns:
+        s = df[name]
+        if s.dtype == object:
+            new = _compact_strings(s)
+        elif pd.api.types.is_integer_dtype(s) and s.dtype.kind in "iu":
+            new = _compact_integers(s)
+        elif s.dtype == np.float64:
+            new = _compact_floats(s)
+        else:
+            new = s
+        columns[name] = new
+        if new.dtype != s.dtype:
+            report.append({
+                "column": str(name),
+                "from": _dtype_name(s.dtype),
+                "to": _dtype_name(new.dtype),
+                "bytes_before": int(s.memory_usage(deep=True, index=False)),
+                "bytes_after": int(new.memory_usage(deep=True, index=False)),
+            })
+    return pd.DataFrame(columns, index=df.index), report
@@ -0,0 +1,111 @@
+import hashlib
+import io
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+import matplotlib
+matplotlib.use("Agg")  # Non-interactive backend, set before pyplot is imported anywhere
+import matplotlib.pyplot as plt
+from utils.cache import LRUCache
+
+IMAGE_DIR = "storage/images"
+os.makedirs(IMAGE_DIR, exist_ok=True)
+IMAGE_TTL = int(os.getenv("IMAGE_TTL", 24 * 3600))  # Seconds a plot stays available
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 64 * 1024**2))  # Rendered variants kept in memory
+DEFAULT_DPI = 100
+MAX_DPI = 300
+FORMATS = {"png": "image/png", "svg": "image/svg+xml", "webp": "image/webp"}
+_ID = re.compile(r"^[0-9a-f]{32}$")
+_rendered = LRUCache(IMAGE_CACHE_MAX_BYTES, sizeof=len)
+_render_lock = threading.Lock()  # pyplot keeps global figure state
+
+
+def _path(image_id, ext):
+    return os.path.join(IMAGE_DIR, f"{image_id}.{ext}")
+
+
+def _write(path, write):
+    """Write through a temporary file, so readers never see a partial file."""
+    try:
+        with open(path + ".tmp", "wb") as f:
+            write(f)
+        os.replace(path + ".tmp", path)
+    finally:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+
+
+def save_figure(fig) -> str:
+    """
+    Store a figure under a new image id: as a PNG at DEFAULT_DPI, the common
+    request, and pickled so other formats and sizes can be rendered later.
+    Figures that can't be pickled (e.g. with a lambda tick formatter) only
+    have the PNG.
+    """
+    prune()
+    image_id = uuid.uuid4().hex
+    _write(_path(image_id, "png"), lambda f: fig.savefig(f, format="png", dpi=DEFAULT_DPI, bbox_inches="tight"))
+    try:
+        _write(_path(image_id, "pickle"), lambda f: pickle.dump(fig, f))
+    except Exception as e:
+        print(f"[IMAGE] {image_id}: figure can't be pickled ({e}); only the default PNG is served")
+    return image_id
+
+
+def exists(image_id) -> bool:
+    return bool(_ID.match(image_id)) and os.path.exists(_path(image_id, "png"))
+
+
+def variant(image_id, fmt, dpi, width):
+    """The (fmt, dpi, width) that will be served: the default PNG when the figure wasn't pickled."""
+    if not os.path.exists(_path(image_id, "pickle")):
+        return "png", DEFAULT_DPI, None
+    return fmt, dpi, width
+
+
+def etag(image_id, fmt, dpi, width) -> str:
+    """Figures never change once stored, so the tag only depends on the requested variant."""
+    return '"' + hashlib.sha256(f"{image_id}:{fmt}:{dpi}:{width}".encode()).hexdigest()[:32] + '"'
+
+
+def render(image_id, fmt="png", dpi=DEFAULT_DPI, width=None) -> bytes:
+    """
+    Bytes of the figure in fmt (see FORMATS). width caps the longer side in
+    pixels, for thumbnails, by lowering the dpi. Blocking; call from a thread.
+    """
+    if fmt == "png" and dpi == DEFAULT_DPI and width is None:
+        with open(_path(image_id, "png"), "rb") as f:
+            return f.read()
+    key = (image_id, fmt, dpi, width)
+    content = _rendered.get(key)
+    if content is not None:
+        return content
+
+    with open(_path(image_id, "pickle"), "rb") as f:
+        payload = f.read()
+    with _render_lock:
+        fig = pickle.loads(payload)
+        try:
+            if width is not None:
+                dpi = min(dpi, width / max(fig.get_size_inches()))
+            buf = io.BytesIO()
+            fig.savefig(buf, format=fmt, dpi=dpi, bbox_inches="tight")
+        finally:
+            plt.close(fig)
+    content = buf.getvalue()
+    _rendered.put(key, content)
+    return content
+
+
+def prune(max_age=IMAGE_TTL):
+    """Remove stored figures older than max_age seconds."""
+    cutoff = time.time() - max_age
+    for entry in os.scandir(IMAGE_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
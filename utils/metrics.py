@@ -0,0 +1,116 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 0))  # Requests slower than this are logged per stage; 0 disables
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+_lock = threading.Lock()
+_histograms = {}  # {(name, labels): [bucket counts..., +Inf count, sum]}
+_counters = {}  # {(name, labels): value}
+_help = {}  # {name: (type, help text)}
+# Stage timings of the current request, [(stage, seconds)]; to_thread and
+# create_task copy the context, so spans in threads land in the same list
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+class _Deferred(list):
+    """Timings recorded by whoever collects them (see collect), not here."""
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, help="", **labels):
+    """Add value to the histogram name{labels}."""
+    with _lock:
+        _help.setdefault(name, ("histogram", help))
+        entry = _histograms.setdefault(_key(name, labels), [0] * (len(BUCKETS) + 1) + [0.0])
+        entry[bisect.bisect_left(BUCKETS, value)] += 1
+        entry[-1] += value
+
+
+def inc(name, value=1, help="", **labels):
+    """Add value to the counter name{labels}."""
+    with _lock:
+        _help.setdefault(name, ("counter", help))
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def record(stage, seconds):
+    """Count a stage timing in the stage histogram and in the current request's timings."""
+    timings = _timings.get()
+    if not isinstance(timings, _Deferred):
+        observe("stage_duration_seconds", seconds, help="Time spent per stage", stage=stage)
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block as `stage` (see record)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def collect(deferred=False):
+    """
+    Collect the stage timings of the enclosed block into the yielded list.
+    With deferred=True they only go to the list, e.g. to be sent from a
+    sandbox worker back to the server process and recorded there.
+    """
+    timings = _Deferred() if deferred else []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def server_timing(timings, total) -> str:
+    """Server-Timing header value: one entry per stage (summed when repeated), then total."""
+    durations = {}
+    for stage, seconds in timings:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in durations.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for name, (kind, text) in sorted(_help.items()):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (n, labels), value in sorted(_counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            for (n, labels), entry in sorted(_histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), entry[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {entry[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
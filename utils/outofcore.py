@@ -0,0 +1,168 @@
+import os
+import pyarrow as pa
+import pyarrow.acero as ac
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
+
+CSV_BLOCK_SIZE = 16 * 1024 * 1024  # Bytes of CSV parsed per batch (and written per Parquet row group)
+PARSE_OPTIONS = pacsv.ParseOptions(newlines_in_values=True)  # Quoted fields may span lines
+AGGREGATE_FUNCTIONS = {"sum", "mean", "min", "max", "count", "count_distinct", "stddev", "variance", "first", "last"}
+
+
+def _csv_blocks(csv_path, block_size):
+    """
+    Yield pieces of the file of about block_size bytes, each ending on a line
+    break outside quotes: a block with an odd number of quote characters ends
+    inside a quoted field ("" escapes count twice), so it takes more lines.
+    """
+    with open(csv_path, "rb") as f:
+        while block := f.read(block_size):
+            block += f.readline()
+            while block.count(b'"') % 2:
+                line = f.readline()
+                if not line:
+                    break
+                block += line
+            yield block
+
+
+def _infer_schema(block):
+    table = pacsv.read_csv(pa.py_buffer(block), parse_options=PARSE_OPTIONS)
+    # Columns that are empty in the first block would otherwise be typed null
+    return pa.schema([f.with_type(pa.string()) if pa.types.is_null(f.type) else f for f in table.schema])
+
+
+def _widen(schema, block, read_options):
+    """
+    schema with the columns whose values in block don't fit it widened:
+    integers to float64 for fractional numbers, anything else to string.
+    Returns None when no column needs widening (the block is malformed).
+    """
+    inferred = pacsv.read_csv(pa.py_buffer(block), read_options=read_options, parse_options=PARSE_OPTIONS).schema
+    fields = []
+    for field in schema:
+        old, new = field.type, inferred.field(field.name).type
+        if new == old or pa.types.is_null(new) or pa.types.is_string(old):
+            fields.append(field)
+        elif pa.types.is_integer(old) and pa.types.is_floating(new):
+            fields.append(field.with_type(pa.float64()))
+        elif pa.types.is_floating(old) and pa.types.is_integer(new):
+            fields.append(field)
+        else:
+            fields.append(field.with_type(pa.string()))
+    widened = pa.schema(fields)
+    return widened if not widened.equals(schema) else None
+
+
+class _Widened(Exception):
+    def __init__(self, schema):
+        self.schema = schema
+
+
+def _write_parquet(csv_path, parquet_path, schema, widen):
+    # Blocks are parsed one by one rather than with pyarrow's streaming reader,
+    # whose background read-ahead can buffer a large part of the file.
+    convert_options = pacsv.ConvertOptions(column_types=schema)
+    with pq.ParquetWriter(parquet_path, schema) as writer:
+        for i, block in enumerate(_csv_blocks(csv_path, CSV_BLOCK_SIZE)):
+            # The first block carries the header
+            read_options = pacsv.ReadOptions() if i == 0 else pacsv.ReadOptions(column_names=schema.names)
+            try:
+                table = pacsv.read_csv(pa.py_buffer(block), read_options=read_options, parse_options=PARSE_OPTIONS, convert_options=convert_options)
+            except pa.ArrowInvalid:
+                widened = _widen(schema, block, read_options) if widen else None
+                if widened is None:
+                    raise
+                raise _Widened(widened)
+            writer.write_table(table.select(schema.names).cast(schema))
+
+
+def csv_to_parquet(csv_path, parquet_path, schema=None):
+    """
+    Convert a CSV to Parquet one block at a time, so memory stays at a few
+    blocks whatever the file size. Column types are inferred from the first
+    block unless a schema is given (as when appending to a dataset, where rows
+    that don't fit raise ArrowInvalid). When a later block has values the
+    inferred types can't hold (2.5 in a column of integers, text in a number
+    column), the column is widened to float64 or string and the conversion
+    restarts. Each block becomes a row group whose min/max statistics let later
+    scans skip data that can't match a filter.
+    """
+    widen = schema is None
+    if schema is None:
+        schema = _infer_schema(next(_csv_blocks(csv_path, CSV_BLOCK_SIZE), b""))
+    while True:
+        try:
+            _write_parquet(csv_path, parquet_path, schema, widen)
+            return
+        except _Widened as e:
+            changed = [f"{f.name}: {f.type} -> {e.schema.field(f.name).type}" for f in schema if f.type != e.schema.field(f.name).type]
+            print(f"[INGEST] {os.path.basename(csv_path)}: widening {', '.join(changed)} and restarting")
+            schema = e.schema
+
+
+def open_dataset(path):
+    return pads.dataset(path, format="parquet")
+
+
+def _plan(ds, columns, filter):
+    decls = [ac.Declaration("scan", ac.ScanNodeOptions(ds, columns=columns, filter=filter))]
+    # The scan only uses the filter to skip row groups; rows are filtered here
+    if filter is not None:
+        decls.append(ac.Declaration("filter", ac.FilterNodeOptions(filter)))
+    decls.append(ac.Declaration("project", ac.ProjectNodeOptions([pc.field(c) for c in columns], columns)))
+    return decls
+
+
+def scan(ds, columns=None, filter=None):
+    """
+    Read only `columns` of the rows matching `filter` (a pyarrow.compute
+    expression such as pc.field("year") == 2024) into a pandas DataFrame.
+    """
+    columns = list(columns) if columns is not None else ds.schema.names
+    return ac.Declaration.from_sequence(_plan(ds, columns, filter)).to_table().to_pandas()
+
+
+def aggregate(ds, aggs, by=None, filter=None):
+    """
+    Streaming group-by over the dataset with bounded memory.
+    aggs maps output names to (column, function), e.g. {"total": ("sales", "sum")};
+    by is an optional list of key columns. Returns a pandas DataFrame.
+    """
+    by = list(by or [])
+    for column, func in aggs.values():
+        if func not in AGGREGATE_FUNCTIONS:
+            raise ValueError(f"Unsupported aggregate function {func!r}; use one of {sorted(AGGREGATE_FUNCTIONS)}")
+    columns = list(dict.fromkeys(by + [column for column, _ in aggs.values()]))
+    prefix = "hash_" if by else ""
+    aggregates = [(column, prefix + func, None, name) for name, (column, func) in aggs.items()]
+    decls = _plan(ds, columns, filter) + [ac.Declaration("aggregate", ac.AggregateNodeOptions(aggregates, keys=by))]
+    return ac.Declaration.from_sequence(decls).to_table().to_pandas()
+
+
+def parquet_statistics(path):
+    """Per-column (rows, nulls, min, max) from the Parquet footers, without reading data."""
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".parquet") and name[0] not in "._"]
+    else:
+        files = [path]
+    rows = 0
+    stats = {}
+    for file in files:
+        metadata = pq.ParquetFile(file).metadata
+        rows += metadata.num_rows
+        for g in range(metadata.num_row_groups):
+            group = metadata.row_group(g)
+            for c in range(group.num_columns):
+                column = group.column(c)
+                entry = stats.setdefault(column.path_in_schema, {"nulls": 0, "min": None, "max": None})
+                s = column.statistics
+                if s is None:
+                    continue
+                entry["nulls"] += s.null_count
+                if s.has_min_max:
+                    entry["min"] = s.min if entry["min"] is None else min(entry["min"], s.min)
+                    entry["max"] = s.max if entry["max"] is None else max(entry["max"], s.max)
+    return rows, stats
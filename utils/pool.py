@@ -0,0 +1,195 @@
+import asyncio
+import multiprocessing as mp
+import os
+import time
+import psutil
+
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", os.cpu_count() or 1))  # 0 runs code in a thread instead
+SANDBOX_TIMEOUT = float(os.getenv("SANDBOX_TIMEOUT", 30))  # Wall-clock seconds per job
+SANDBOX_MAX_RSS_MB = int(os.getenv("SANDBOX_MAX_RSS_MB", 2048))  # Resident memory per worker
+# Frames each worker may cache. Default: a quarter of the RSS limit (memory-mapped
+# pages count towards RSS; the rest is left for running the query), and no more
+# than an equal share of CSV_CACHE_MAX_BYTES, so all workers together stay within it.
+SANDBOX_CACHE_MAX_BYTES = os.getenv("SANDBOX_CACHE_MAX_BYTES")
+POLL_INTERVAL = 0.02
+
+
+def run_job(file_id, code, version=None, columns=None):
+    """
+    Load the data of file_id and run code on it: a DataFrame, or a dataset for
+    large files. version is the file's content hash, so frames cached before an
+    append are reloaded; columns, when known, limit what is read from disk
+    (see data.get_csv). The output's `timings` lists the stages (load, exec,
+    render, serialize) for the caller to record, see utils/metrics.py, and
+    `cache` the worker's frame cache counters.
+    """
+    import data
+    from utils import metrics
+
+    with metrics.collect(deferred=True) as timings:
+        output = _load_and_run(file_id, code, version, columns)
+    output["timings"] = list(timings)
+    output["cache"] = data.cache_stats()
+    return output
+
+
+def _load_and_run(file_id, code, version, columns):
+    import data
+    from utils.sand import execute_code
+
+    data.check_version(file_id, version)
+    if data.is_large(file_id):
+        return execute_code(code, None, dataset=data.get_dataset(file_id))
+    df = data.get_csv(file_id, columns)
+    if df is None:
+        return {"result": None, "result_id": None, "rows": None, "image_id": None, "error": f"File {file_id} not found"}
+    return execute_code(code, df)
+
+
+def _worker_main(conn, cache_bytes):
+    """
+    Entry point of a sandbox worker process. Heavy imports happen once here so
+    jobs only pay for loading (memory-mapping) their frame and running the code.
+    """
+    import utils.images  # noqa: F401  (selects the Agg backend and imports pyplot)
+    import numpy  # noqa: F401
+    import data
+    import utils.sand  # noqa: F401
+
+    data.set_cache_budget(cache_bytes)
+
+    conn.send("ready")
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        conn.send(run_job(*job))
+
+
+class _Worker:
+    def __init__(self, ctx, cache_bytes):
+        self.conn, child_conn = ctx.Pipe()
+        self.cache = {"entries": 0, "bytes": 0, "max_bytes": cache_bytes, "hits": 0, "misses": 0, "evictions": 0}
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, cache_bytes), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class SandboxPool:
+    """
+    Pool of pre-started worker processes that run generated code. Each job gets
+    a wall-clock and RSS limit; a worker that overruns is killed and replaced.
+    """
+
+    def __init__(self, workers=SANDBOX_WORKERS, timeout=SANDBOX_TIMEOUT, max_rss_mb=SANDBOX_MAX_RSS_MB):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.cache_bytes = None
+        self._ctx = mp.get_context("spawn")
+        self._idle = None
+        self._all = set()
+
+    def start(self):
+        import data
+
+        if self.workers == 0:
+            return
+        if SANDBOX_CACHE_MAX_BYTES is not None:
+            self.cache_bytes = int(SANDBOX_CACHE_MAX_BYTES)
+        else:
+            self.cache_bytes = min(self.max_rss // 4, data.CACHE_MAX_BYTES // self.workers)
+        # Code runs in the workers, so frames cached here would never be used
+        data.set_cache_budget(0)
+        self._idle = asyncio.Queue()
+        for _ in range(self.workers):
+            self._add_worker()
+
+    def shutdown(self):
+        for worker in list(self._all):
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=2)
+            if worker.process.is_alive():
+                worker.kill()
+        self._all.clear()
+
+    def _add_worker(self):
+        worker = _Worker(self._ctx, self.cache_bytes)
+        self._all.add(worker)
+        self._idle.put_nowait(worker)
+
+    def _release(self, worker, fut):
+        if fut.cancelled() or fut.exception() is not None or fut.result()[1]:
+            self._all.discard(worker)
+            worker.kill()
+            self._add_worker()
+        else:
+            self._idle.put_nowait(worker)
+
+    async def run(self, file_id, code, version=None, columns=None):
+        """Run code against the frame of file_id and return execute_code's output dict."""
+        if self.workers == 0:
+            output = await asyncio.to_thread(run_job, file_id, code, version, columns)
+            output.pop("cache", None)
+            return output
+
+        worker = await self._idle.get()
+        fut = asyncio.ensure_future(asyncio.to_thread(self._run_job, worker, (file_id, code, version, columns)))
+        # The worker goes back to the pool (or is replaced) only once the job has
+        # really finished, even if this request is cancelled meanwhile.
+        fut.add_done_callback(lambda f: self._release(worker, f))
+        output, _ = await asyncio.shield(fut)
+        worker.cache = output.pop("cache", worker.cache)
+        return output
+
+    def cache_stats(self):
+        """
+        Frame cache counters: summed over the workers (as of their last job),
+        with a per-worker breakdown, or this process's cache without workers.
+        """
+        import data
+
+        if self.workers == 0:
+            return data.cache_stats()
+        per_worker = [worker.cache for worker in self._all]
+        totals = {key: sum(stats[key] for stats in per_worker) for key in ("entries", "bytes", "max_bytes", "hits", "misses", "evictions")}
+        return dict(totals, workers=per_worker)
+
+    def _run_job(self, worker, job):
+        """Blocking: send a job and wait for it under the limits. Returns (output, must_respawn)."""
+        output = {"result": None, "result_id": None, "rows": None, "image_id": None, "error": None}
+        try:
+            worker.conn.send(job)
+            proc = psutil.Process(worker.process.pid)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                if worker.conn.poll(POLL_INTERVAL):
+                    message = worker.conn.recv()
+                    if message == "ready":
+                        # A freshly started worker finished its imports; the job starts now
+                        deadline = time.monotonic() + self.timeout
+                        continue
+                    return message, False
+                if not worker.process.is_alive():
+                    output["error"] = "Sandbox worker crashed"
+                    return output, True
+                if time.monotonic() > deadline:
+                    output["error"] = "Code execution timed out"
+                    return output, True
+                if proc.memory_info().rss > self.max_rss:
+                    output["error"] = "Code execution exceeded the memory limit"
+                    return output, True
+        except (EOFError, OSError, psutil.Error):
+            output["error"] = "Sandbox worker crashed"
+            return output, True
@@ -0,0 +1,113 @@
+import math
+import os
+import pandas as pd
+from utils.tokens import count_text_tokens
+
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", 100_000))  # Rows used for cardinality/top values
+PROFILE_MAX_TOKENS = int(os.getenv("PROFILE_MAX_TOKENS", 800))  # Cap on the rendered summary sent to the LLM
+TOP_VALUES = 5
+SAMPLE_VALUES = 3
+MAX_VALUE_CHARS = 40
+
+
+def _jsonable(value):
+    if value is None:
+        return None
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, (int, float, bool, str)):
+        return value
+    return str(value)
+
+
+def _short(value):
+    text = f"{value:.6g}" if isinstance(value, float) else str(value)
+    return text if len(text) <= MAX_VALUE_CHARS else text[:MAX_VALUE_CHARS - 3] + "..."
+
+
+def build_profile(df: pd.DataFrame, sample_rows=PROFILE_SAMPLE_ROWS) -> dict:
+    """
+    Summarise a frame once so prompts don't have to. Null counts and min/max
+    use the whole frame; cardinality, top values and samples use a random
+    sample of at most sample_rows rows.
+    """
+    sampled = len(df) > sample_rows
+    sample = df.sample(sample_rows, random_state=0) if sampled else df
+
+    nulls = df.isna().sum()
+    unique = sample.nunique(dropna=True)
+    numeric = df.select_dtypes(include=["number", "datetime"])
+    bounds = numeric.agg(["min", "max"]) if not numeric.empty else pd.DataFrame()
+
+    stats = []
+    for column in df.columns:
+        entry = {
+            "name": str(column),
+            "dtype": str(df[column].dtype),
+            "nulls": int(nulls[column]),
+            "unique": int(unique[column]),
+        }
+        if column in bounds.columns:
+            entry["min"] = _jsonable(bounds.at["min", column])
+            entry["max"] = _jsonable(bounds.at["max", column])
+        else:
+            values = sample[column].dropna()
+            # Top categories only make sense when values repeat
+            if entry["unique"] <= len(values) // 2:
+                entry["top"] = [_jsonable(v) for v in values.value_counts().index[:TOP_VALUES]]
+            entry["samples"] = [_jsonable(v) for v in values.drop_duplicates().head(SAMPLE_VALUES)]
+        stats.append(entry)
+
+    profile = {
+        "rows": int(len(df)),
+        "columns": [str(c) for c in df.columns],
+        "dtypes": {str(c): str(t) for c, t in df.dtypes.items()},
+        "sampled": sampled,
+        "stats": stats,
+    }
+    profile["summary"] = render_profile(profile)
+    return profile
+
+
+def build_dataset_profile(sample: pd.DataFrame, rows: int, column_stats: dict) -> dict:
+    """
+    Profile of a file too large to load: cardinality, top values and samples
+    come from `sample`, while row count, null counts and min/max come from the
+    Parquet statistics of the whole file (see utils/outofcore.parquet_statistics).
+    """
+    profile = build_profile(sample, sample_rows=max(len(sample), 1))
+    profile.update(rows=int(rows), sampled=True, engine="arrow")
+    for entry in profile["stats"]:
+        stats = column_stats.get(entry["name"])
+        if stats is None:
+            continue
+        entry["nulls"] = int(stats["nulls"])
+        if "min" in entry and stats["min"] is not None:
+            entry["min"], entry["max"] = _jsonable(stats["min"]), _jsonable(stats["max"])
+    profile["summary"] = render_profile(profile)
+    return profile
+
+
+def render_profile(profile: dict, max_tokens=PROFILE_MAX_TOKENS) -> str:
+    """Compact one-line-per-column text of a profile, cut off at max_tokens."""
+    header = f"{profile['rows']} rows x {len(profile['columns'])} columns" + (" (cardinality from a sample)" if profile["sampled"] else "")
+    lines = [header]
+    used = count_text_tokens(header)
+    for i, entry in enumerate(profile["stats"]):
+        parts = [f"- {entry['name']} ({entry['dtype']})", f"nulls={entry['nulls']}", f"unique={entry['unique']}"]
+        if "min" in entry:
+            parts.append(f"min={_short(entry['min'])} max={_short(entry['max'])}")
+        if entry.get("top"):
+            parts.append("top=[" + ", ".join(_short(v) for v in entry["top"]) + "]")
+        elif entry.get("samples"):
+            parts.append("e.g.=[" + ", ".join(_short(v) for v in entry["samples"]) + "]")
+        line = " ".join(parts)
+        used += count_text_tokens(line)
+        if used > max_tokens:
+            rest = profile["columns"][i:]
+            lines.append(f"... {len(rest)} more columns: {', '.join(rest)}")
+            break
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,125 @@
+import json
+import os
+import re
+import time
+import uuid
+import pandas as pd
+import pyarrow as pa
+
+RESULT_DIR = "storage/results"
+os.makedirs(RESULT_DIR, exist_ok=True)
+RESULT_PREVIEW_ROWS = int(os.getenv("RESULT_PREVIEW_ROWS", 50))  # Rows of a table result inlined in /chat responses
+RESULT_TTL = int(os.getenv("RESULT_TTL", 24 * 3600))  # Seconds a stored result stays available
+RESULT_PAGE_MAX_ROWS = 10_000
+BATCH_ROWS = 64 * 1024  # Rows per Arrow record batch on disk and in downloads
+_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _path(result_id):
+    return os.path.join(RESULT_DIR, f"{result_id}.arrow")
+
+
+def _to_table(df: pd.DataFrame) -> pa.Table:
+    # The index is stored as a column, even a RangeIndex, so pages keep their row labels
+    try:
+        return pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columns mixing Python types have no Arrow equivalent; keep their text
+        mixed = {c: df[c].astype(str) for c in df.columns if df[c].dtype == object}
+        return pa.Table.from_pandas(df.assign(**mixed), preserve_index=True)
+
+
+def _unique_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Columns as strings, with repeated names suffixed .1, .2, ... as pandas.read_csv does."""
+    names, seen = [], {}
+    for name in map(str, df.columns):
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        names.append(name if count == 0 else f"{name}.{count}")
+    return df.set_axis(names, axis=1)
+
+
+def save_result(x):
+    """
+    Keep a DataFrame/Series result server-side when it has more than
+    RESULT_PREVIEW_ROWS rows. Returns (preview, result_id, rows): the preview
+    is the first rows in to_dict() form; result_id is None when nothing was
+    cut off.
+    """
+    df = _unique_columns(x.to_frame() if isinstance(x, pd.Series) else x)
+    rows = len(df)
+    preview = (df if isinstance(x, pd.DataFrame) else x).head(RESULT_PREVIEW_ROWS).to_dict()
+    if rows <= RESULT_PREVIEW_ROWS:
+        return preview, None, rows
+
+    try:
+        table = _to_table(df)
+    except ValueError as e:
+        # Still answer with the preview rather than losing the result
+        print(f"[RESULT] Table result can't be stored ({e}); returning the preview only")
+        return preview, None, rows
+    prune()
+    result_id = uuid.uuid4().hex
+    # Arrow IPC file format: pages are read from a memory map without loading the rest
+    with pa.OSFile(_path(result_id) + ".tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=BATCH_ROWS)
+    os.replace(_path(result_id) + ".tmp", _path(result_id))
+    return preview, result_id, rows
+
+
+def exists(result_id) -> bool:
+    return bool(_ID.match(result_id)) and os.path.exists(_path(result_id))
+
+
+def _open(result_id):
+    return pa.ipc.open_file(pa.memory_map(_path(result_id)))
+
+
+def read_page(result_id, offset, limit):
+    """Rows [offset, offset + limit) of a stored result as {"columns", "index", "data"}, plus the total row count."""
+    table = _open(result_id).read_all()
+    page = table.slice(offset, limit).to_pandas()
+    return json.loads(page.to_json(orient="split", date_format="iso")), table.num_rows
+
+
+class _Chunks:
+    """Write-only file object that hands back what was written since the last take()."""
+
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def stream_arrow(result_id):
+    """Yield a stored result as an Arrow IPC stream, one record batch at a time."""
+    reader = _open(result_id)
+    sink = _Chunks()
+    with pa.ipc.new_stream(sink, reader.schema) as writer:
+        for i in range(reader.num_record_batches):
+            writer.write_batch(reader.get_batch(i))
+            yield sink.take()
+    yield sink.take()
+
+
+def prune(max_age=RESULT_TTL):
+    """Remove stored results older than max_age seconds."""
+    cutoff = time.time() - max_age
+    for entry in os.scandir(RESULT_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
@@ -1,43 +1,79 @@
 import pandas as pd
+import pyarrow.compute as pc
 # import matplotlib.pyplot as plt
-import io
-import base64
+import os
+from utils import outofcore, images, results, metrics, analyze
 
-def execute_code(code: str, df: pd.DataFrame):
+# "cow": generated code gets a lazy copy-on-write view of the cached frame, so
+# columns are only duplicated when the code writes to them.
+# "deep": full df.copy() per request (previous behaviour).
+COPY_MODE = os.getenv("SANDBOX_COPY_MODE", "cow")
+if COPY_MODE == "cow":
+    pd.set_option("mode.copy_on_write", True)
+
+
+def _sandbox_frame(df: pd.DataFrame) -> pd.DataFrame:
+    if COPY_MODE == "cow":
+        # Under copy-on-write a shallow copy shares buffers until either side is
+        # modified, and any write (including inplace=True) copies first, so the
+        # cached original is never changed.
+        return df.copy(deep=False)
+    return df.copy()
+
+
+def execute_code(code: str, df: pd.DataFrame, dataset=None):
+    """
+    Run generated code and collect `result` and the last figure, which is
+    stored by utils/images.py and returned as an `image_id`. Large table
+    results are stored by utils/results.py: `result` then holds a preview and
+    `result_id` names the full table. For files
+    queried out-of-core, pass the pyarrow dataset instead of a frame: the code
+    then gets `ds`, `pc` and the scan/aggregate helpers from utils/outofcore.py.
+    """
     safe_globals = {"pd": pd}
-    safe_locals = {"df": df.copy()}
+    if dataset is not None:
+        safe_locals = {"ds": dataset, "pc": pc, "scan": outofcore.scan, "aggregate": outofcore.aggregate}
+    else:
+        safe_locals = {"df": _sandbox_frame(df)}
 
-    output = {"result": None, "image": None, "error": None}
+    output = {"result": None, "result_id": None, "rows": None, "image_id": None, "error": None}
     
 
     try:
 
-        exec(code, safe_globals, safe_locals)
+        with metrics.span("exec"):
+            exec(analyze.compile_code(code), safe_globals, safe_locals)
         plt = safe_locals.get("plt")
 
         
 
         if plt:
             figs = [plt.figure(n) for n in plt.get_fignums()]
-            buf = io.BytesIO()
-            figs[-1].savefig(buf, format="png", bbox_inches="tight")
-            buf.seek(0)
-            img_base64 = base64.b64encode(buf.read()).decode("utf-8")
-            output["image"] = img_base64 
+            if figs:
+                with metrics.span("render"):
+                    # A plot that can't be stored must not discard the computed result
+                    try:
+                        output["image_id"] = images.save_figure(figs[-1])
+                    except Exception as e:
+                        print(f"[IMAGE] Figure could not be stored: {e}")
             plt.close("all")
         
         # Safely extract result: Coerce scalars to strings to avoid downstream iteration errors
         x = safe_locals.get("result")
         print(x)
        
-        # Convert DataFrame/Series to dict (for JSON serialization)
-        if hasattr(x, "to_dict"):
-            output["result"] = x.to_dict()
-        else:
-            output["result"] = str(x)
+        # Convert DataFrame/Series to dict (for JSON serialization); only a
+        # preview of large ones, the full table stays server-side
+        with metrics.span("serialize"):
+            if isinstance(x, (pd.DataFrame, pd.Series)):
+                output["result"], output["result_id"], output["rows"] = results.save_result(x)
+            elif hasattr(x, "to_dict"):
+                output["result"] = x.to_dict()
+            else:
+                output["result"] = str(x)
 
     except TimeoutError:
-        return {output["error"]: "Code execution timed out"}
+        output["error"] = "Code execution timed out"
 
     except Exception as e:
         output["error"]=str(e)
@@ -0,0 +1,236 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import time
+import openai
+from utils import metrics
+from utils.tokens import count_tokens
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 16))  # LLM calls in flight at once
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", 500))  # Keep below the provider's limits
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", 200_000))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 256))  # Waiting calls beyond this are rejected (HTTP 429)
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 30))  # Seconds a call may wait for admission
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 4))
+COMPLETION_TOKENS_ESTIMATE = 512  # Charged up front; corrected from the reported usage afterwards
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20.0
+
+# Priorities, lower is served first
+INTERACTIVE = 0
+BATCH = 1
+BACKGROUND = 2
+
+RETRYABLE = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class Saturated(Exception):
+    """The LLM queue is full or a call waited too long; retry after retry_after seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLM capacity exhausted, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Bucket:
+    """Token bucket holding up to one minute of budget, refilled continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        """Seconds until `amount` is available (0 when it already is)."""
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+def _key(messages):
+    payload = json.dumps([[m.type, m.name, m.content] for m in messages], default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _retry_delay(attempt, error):
+    """Full-jitter exponential backoff, or the provider's Retry-After when it sent one."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class LLMScheduler:
+    """
+    Admission control in front of the chat model. Calls wait in a priority
+    queue until a concurrency slot and enough request and token budget are
+    free; a full queue is rejected with Saturated. Identical in-flight calls
+    (same messages) share one LLM round-trip, and rate-limit or transient
+    provider errors are retried with jittered backoff.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=LLM_TOKENS_PER_MINUTE, max_queue=LLM_MAX_QUEUE,
+                 queue_timeout=LLM_QUEUE_TIMEOUT, max_retries=LLM_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self._requests = _Bucket(requests_per_minute)
+        self._tokens = _Bucket(tokens_per_minute)
+        self._running = 0
+        self._waiting = 0  # Calls accepted but not admitted yet (queued, or about to be)
+        self._queue = []  # heap of (priority, seq, tokens, future)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._loop = None
+        self._inflight = {}  # {messages key: task}, for coalescing
+
+    def retry_after(self) -> int:
+        """Seconds a new call would roughly wait: the queue drains at the request rate."""
+        return max(1, math.ceil(self._waiting / self._requests.rate))
+
+    def check_capacity(self):
+        """Raise Saturated if a new call would be rejected, e.g. before starting a stream."""
+        if self._waiting >= self.max_queue:
+            metrics.inc("llm_rejected_total", help="LLM calls rejected by admission control")
+            raise Saturated(self.retry_after())
+
+    async def invoke(self, llm, messages, priority=INTERACTIVE):
+        """llm.ainvoke(messages) through the queue; identical concurrent calls share the response."""
+        key = _key(messages)
+        task = self._inflight.get(key)
+        if task is None:
+            self.check_capacity()
+            self._waiting += 1
+            task = asyncio.create_task(self._invoke(llm, messages, priority))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            metrics.inc("llm_coalesced_total", help="LLM calls answered by an identical in-flight call")
+        # Shielded: one caller giving up must not cancel the call for the others
+        return await asyncio.shield(task)
+
+    async def stream(self, llm, messages, priority=INTERACTIVE):
+        """
+        llm.astream(messages) through the queue. Streams are not shared; they are
+        retried only if they fail before the first chunk.
+        """
+        self.check_capacity()
+        self._waiting += 1
+        estimate = await self._acquire(messages, priority)
+        usage = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                started = False
+                try:
+                    async for chunk in llm.astream(messages):
+                        started = True
+                        usage = getattr(chunk, "usage_metadata", None) or usage
+                        yield chunk
+                    return
+                except RETRYABLE as e:
+                    if started or attempt == self.max_retries:
+                        raise
+                    await self._backoff(attempt, e)
+        finally:
+            self._release(estimate, usage)
+
+    async def _invoke(self, llm, messages, priority):
+        estimate = await self._acquire(messages, priority)
+        response = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await llm.ainvoke(messages)
+                    return response
+                except RETRYABLE as e:
+                    if attempt == self.max_retries:
+                        raise
+                    await self._backoff(attempt, e)
+        finally:
+            self._release(estimate, getattr(response, "usage_metadata", None))
+
+    async def _backoff(self, attempt, error):
+        delay = _retry_delay(attempt, error)
+        metrics.inc("llm_retries_total", help="LLM calls retried after a rate-limit or transient error")
+        print(f"[LLM] {type(error).__name__}, retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        # Each attempt is a request against the provider's limit
+        self._requests.refill()
+        self._requests.level -= 1
+
+    async def _acquire(self, messages, priority):
+        """Wait for admission (the caller counted itself in _waiting) and return the tokens charged."""
+        try:
+            estimate = min(count_tokens(messages) + COMPLETION_TOKENS_ESTIMATE, self._tokens.capacity)
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (priority, next(self._seq), estimate, future))
+            self._ensure_dispatcher()
+            self._wakeup.set()
+            with metrics.span("queue"):
+                try:
+                    await asyncio.wait_for(future, self.queue_timeout)
+                except asyncio.TimeoutError:
+                    metrics.inc("llm_rejected_total", help="LLM calls rejected by admission control")
+                    raise Saturated(self.retry_after())
+        finally:
+            self._waiting -= 1
+        return estimate
+
+    def _release(self, estimate, usage):
+        self._running -= 1
+        if usage:
+            # Settle the token charge with what was really used
+            actual = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+            self._tokens.refill()
+            self._tokens.level += estimate - actual
+        self._wakeup.set()
+
+    def _ensure_dispatcher(self):
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None or self._dispatcher.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        """Admit queued calls in priority order while slots and budget allow."""
+        while True:
+            # Waiters that timed out or were cancelled
+            while self._queue and self._queue[0][3].done():
+                heapq.heappop(self._queue)
+            if not self._queue or self._running >= self.max_concurrency:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, _, estimate, future = self._queue[0]
+            self._requests.refill()
+            self._tokens.refill()
+            wait = max(self._requests.wait_for(1), self._tokens.wait_for(estimate))
+            if wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._queue)
+            self._requests.level -= 1
+            self._tokens.level -= estimate
+            self._running += 1
+            future.set_result(None)
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")  # "sqlite" or "redis"
+STATE_PATH = os.getenv("STATE_PATH", "storage/state.sqlite")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "csvchat:")
+LEASE_POLL = 0.05
+
+
+class SQLiteState:
+    """
+    JSON values in namespaces, with optional expiry, in a SQLite file that
+    every worker process on the host opens (WAL mode, so readers don't block
+    the writer). Lists keep one row per item, so appends don't rewrite them.
+    Blocking (SQLite waits up to 30s for another process's write); call from
+    a thread in async code.
+    """
+
+    def __init__(self, path=STATE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS state (
+                    ns TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires REAL,
+                    PRIMARY KEY (ns, key)
+                )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS lists (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ns TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires REAL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lists_key ON lists (ns, key, seq)")
+
+    def _transaction(self, statements):
+        """Run statements(conn) in one write transaction, visible to other processes all at once."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return result
+
+    def get(self, ns, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM state WHERE ns = ? AND key = ? AND (expires IS NULL OR expires > ?)",
+                (ns, key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set(self, ns, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state (ns, key, value, expires) VALUES (?, ?, ?, ?)",
+                (ns, key, json.dumps(value), expires),
+            )
+
+    def add(self, ns, key, value, ttl=None) -> bool:
+        """Set key only if it is absent (or expired); True if it was set."""
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            cursor = self._conn.execute(
+                """INSERT INTO state (ns, key, value, expires) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, expires = excluded.expires
+                   WHERE state.expires IS NOT NULL AND state.expires <= ?""",
+                (ns, key, json.dumps(value), expires, now),
+            )
+        return cursor.rowcount > 0
+
+    def incr(self, ns, key, delta=1) -> int:
+        """Atomically add delta to an integer value (0 when absent) and return the result."""
+        with self._lock:
+            row = self._conn.execute(
+                """INSERT INTO state (ns, key, value) VALUES (?, ?, ?)
+                   ON CONFLICT (ns, key) DO UPDATE SET value = CAST(value AS INTEGER) + ?
+                   RETURNING value""",
+                (ns, key, str(delta), delta),
+            ).fetchone()
+        return int(row[0])
+
+    def items(self, ns, key) -> list:
+        """The values of the list at key, oldest first ([] when absent)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT value FROM lists WHERE ns = ? AND key = ? AND (expires IS NULL OR expires > ?) ORDER BY seq",
+                (ns, key, time.time()),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def push(self, ns, key, values, ttl=None):
+        """Atomically append values to the list at key; ttl renews the expiry of the whole list."""
+        expires = time.time() + ttl if ttl is not None else None
+
+        def statements(conn):
+            conn.executemany(
+                "INSERT INTO lists (ns, key, value, expires) VALUES (?, ?, ?, ?)",
+                [(ns, key, json.dumps(value), expires) for value in values],
+            )
+            conn.execute("UPDATE lists SET expires = ? WHERE ns = ? AND key = ?", (expires, ns, key))
+
+        self._transaction(statements)
+
+    def replace_head(self, ns, key, count, values, ttl=None):
+        """Atomically replace the first count items of the list at key with values, keeping the items after them."""
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+
+        def statements(conn):
+            rest = conn.execute(
+                "SELECT value FROM lists WHERE ns = ? AND key = ? AND (expires IS NULL OR expires > ?) ORDER BY seq LIMIT -1 OFFSET ?",
+                (ns, key, now, count),
+            ).fetchall()
+            conn.execute("DELETE FROM lists WHERE ns = ? AND key = ?", (ns, key))
+            conn.executemany(
+                "INSERT INTO lists (ns, key, value, expires) VALUES (?, ?, ?, ?)",
+                [(ns, key, json.dumps(value), expires) for value in values] + [(ns, key, row[0], expires) for row in rest],
+            )
+
+        self._transaction(statements)
+
+    def expire(self, ns, key, ttl) -> bool:
+        """Renew the expiry of the list at key; False if it doesn't exist (or has expired)."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE lists SET expires = ? WHERE ns = ? AND key = ? AND (expires IS NULL OR expires > ?)",
+                (now + ttl, ns, key, now),
+            )
+        return cursor.rowcount > 0
+
+    def delete(self, ns, key):
+        """Remove the value or list at key."""
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE ns = ? AND key = ?", (ns, key))
+            self._conn.execute("DELETE FROM lists WHERE ns = ? AND key = ?", (ns, key))
+
+    def purge_expired(self):
+        with self._lock:
+            now = time.time()
+            self._conn.execute("DELETE FROM state WHERE expires IS NOT NULL AND expires <= ?", (now,))
+            self._conn.execute("DELETE FROM lists WHERE expires IS NOT NULL AND expires <= ?", (now,))
+
+
+def _ms(ttl):
+    return max(1, int(ttl * 1000)) if ttl is not None else None
+
+
+class RedisState:
+    """
+    The same interface on a Redis (or Redis-compatible) server shared by
+    several hosts; lists are Redis lists. Each call is a network round trip,
+    so call from a thread in async code.
+    """
+
+    def __init__(self, url=REDIS_URL, prefix=REDIS_PREFIX):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)")
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def _key(self, ns, key):
+        return f"{self._prefix}{ns}:{key}"
+
+    def get(self, ns, key, default=None):
+        value = self._redis.get(self._key(ns, key))
+        return json.loads(value) if value is not None else default
+
+    def set(self, ns, key, value, ttl=None):
+        self._redis.set(self._key(ns, key), json.dumps(value), px=_ms(ttl))
+
+    def add(self, ns, key, value, ttl=None) -> bool:
+        return bool(self._redis.set(self._key(ns, key), json.dumps(value), nx=True, px=_ms(ttl)))
+
+    def incr(self, ns, key, delta=1) -> int:
+        return int(self._redis.incrby(self._key(ns, key), delta))
+
+    def items(self, ns, key) -> list:
+        return [json.loads(value) for value in self._redis.lrange(self._key(ns, key), 0, -1)]
+
+    def push(self, ns, key, values, ttl=None):
+        with self._redis.pipeline() as pipe:  # MULTI/EXEC
+            if values:
+                pipe.rpush(self._key(ns, key), *[json.dumps(value) for value in values])
+            if ttl is not None:
+                pipe.pexpire(self._key(ns, key), _ms(ttl))
+            pipe.execute()
+
+    def replace_head(self, ns, key, count, values, ttl=None):
+        with self._redis.pipeline() as pipe:
+            pipe.ltrim(self._key(ns, key), count, -1)
+            if values:
+                pipe.lpush(self._key(ns, key), *[json.dumps(value) for value in reversed(values)])
+            if ttl is not None:
+                pipe.pexpire(self._key(ns, key), _ms(ttl))
+            pipe.execute()
+
+    def expire(self, ns, key, ttl) -> bool:
+        return bool(self._redis.pexpire(self._key(ns, key), _ms(ttl)))
+
+    def delete(self, ns, key):
+        self._redis.delete(self._key(ns, key))
+
+    def purge_expired(self):
+        pass  # Redis expires keys itself
+
+
+def open_state():
+    if STATE_BACKEND == "redis":
+        return RedisState()
+    if STATE_BACKEND == "sqlite":
+        return SQLiteState()
+    raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND!r}; use 'sqlite' or 'redis'")
+
+
+@asynccontextmanager
+async def lease(state, name, ttl=600):
+    """
+    Cross-process lock: hold `name` for the enclosed block, or until ttl
+    seconds pass if the holder dies.
+    """
+    while not await asyncio.to_thread(state.add, "lease", name, True, ttl):
+        await asyncio.sleep(LEASE_POLL)
+    try:
+        yield
+    finally:
+        await asyncio.to_thread(state.delete, "lease", name)
+
+
+STATE = open_state()  # Shared by data.py and calls.py; see STATE_BACKEND
@@ -0,0 +1,27 @@
+import functools
+
+MODEL = "gpt-4o-mini"
+MESSAGE_OVERHEAD = 4  # Role/separator tokens the chat format adds per message
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    # tiktoken downloads its BPE tables on first use; without network access
+    # fall back to the ~4 characters per token rule of thumb.
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(MODEL)
+    except Exception:
+        return None
+
+
+def count_text_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def count_tokens(messages) -> int:
+    """Approximate prompt tokens for a list of langchain messages."""
+    return sum(count_text_tokens(str(m.content)) + MESSAGE_OVERHEAD for m in messages)